@@ -1,41 +1,188 @@
 import argparse
+import ast
+import cProfile
+import gzip
+import difflib
+import hashlib
 import io
+import itertools
 import json
 import logging
 import os
+import pickle
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
 import time
-from datetime import datetime
+import unicodedata
+from dataclasses import dataclass, field, fields, replace
+from typing import Any, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from http import HTTPStatus
 
 import mysql.connector as MySQL
+import numpy as np
 import pandas as pd
 import requests
 # import schedule
-from bs4 import BeautifulSoup
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+from bs4 import BeautifulSoup, SoupStrainer
 from decouple import config
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
 # from selenium import webdriver
 # from selenium.webdriver.firefox.service import Service
 import argparse
 
 GOOGLE_API_KEY = config('GOOGLE_API_KEY')
-HOST = 'mysqldb'
+HOST = config('MYSQL_HOST', default='mysqldb')
 # HOST = '143.198.57.221'
+PORT = config('MYSQL_PORT', default=3306, cast=int)
 DBUSER = config('MYSQL_USER')
 PASSWORD = config('MYSQL_PASSWORD')
 DATABASE = config('MYSQL_DATABASE')
-GOOGLE_API_URL = "https://maps.googleapis.com/maps/api/geocode/json?address="
+GOOGLE_API_URL = config(
+    "GOOGLE_API_URL",
+    default="https://maps.googleapis.com/maps/api/geocode/json?address=",
+)
 PROVINCE = "Ontario"
-RESOURCE_API = "https://ckan0.cf.opendata.inter.prod-toronto.ca/api/3/action/package_show?id=da46e4ac-d4ab-4b1c-b139-6362a0a43b3c"
+RESOURCE_API = config(
+    "RESOURCE_API",
+    default="https://ckan0.cf.opendata.inter.prod-toronto.ca/api/3/action/package_show?id=da46e4ac-d4ab-4b1c-b139-6362a0a43b3c",
+)
 FACILITY_LIST_URL = "https://www.toronto.ca/data/parks/prd/facilities/recreationcentres/index.html"
 CITY_OF_TORONTO_URL = "https://www.toronto.ca"
-FACILITY_URL_PREFIX = "https://www.toronto.ca/data/parks/prd/facilities/complex/"
+FACILITY_URL_PREFIX = config(
+    "FACILITY_URL_PREFIX",
+    default="https://www.toronto.ca/data/parks/prd/facilities/complex/",
+)
 LOCATIONS = "Locations"
+# whole words only, "Mon", "Tues", "Wednesdays" or "We"
+WEEKDAY_NAMES = [
+    ["monday", "mondays", "mon", "mo"],
+    ["tuesday", "tuesdays", "tues", "tue", "tu"],
+    ["wednesday", "wednesdays", "weds", "wed", "we"],
+    ["thursday", "thursdays", "thurs", "thur", "thu", "th"],
+    ["friday", "fridays", "fri", "fr"],
+    ["saturday", "saturdays", "sat", "sa"],
+    ["sunday", "sundays", "sun", "su"],
+]
+WEEKDAYS = {name: {day} for day, names in enumerate(WEEKDAY_NAMES) for name in names}
+WEEKDAYS.update(
+    {
+        "weekday": {0, 1, 2, 3, 4},
+        "weekdays": {0, 1, 2, 3, 4},
+        "weekend": {5, 6},
+        "weekends": {5, 6},
+    }
+)
+# single letter forms, "M W F" or "TR"
+WEEKDAY_LETTERS = {"m": 0, "t": 1, "w": 2, "r": 3, "f": 4, "s": 5, "u": 6}
 DROPIN = "Drop-in.json"
 FACILITIES = "Facilities.json"
 REGISTERED_PROGRAMS = "Registered Programs.json"
+# downloads share one pooled session with timeouts and retries
+HTTP_TIMEOUT = config("HTTP_TIMEOUT", default=30, cast=float)
+HTTP_RETRIES = config("HTTP_RETRIES", default=3, cast=int)
+HTTP_BACKOFF = config("HTTP_BACKOFF", default=0.5, cast=float)
+HTTP_POOL_SIZE = config("HTTP_POOL_SIZE", default=8, cast=int)
+# chunk size for streamed downloads and parsing
+STREAM_CHUNK_SIZE = config("STREAM_CHUNK_SIZE", default=65536, cast=int)
+# per stage timings of the last run, an empty path disables that output
+STAGE_REPORT_PATH = config("STAGE_REPORT_PATH", default="stage_report.json")
+STAGE_METRICS_PATH = config("STAGE_METRICS_PATH", default="stage_metrics.prom")
+# availabilities are written to parquet in batches of this many rows
+EXPORT_BATCH_SIZE = config("EXPORT_BATCH_SIZE", default=100000, cast=int)
+# raw responses of each run are kept here, recording is off unless it is set
+SNAPSHOT_DIR = config("SNAPSHOT_DIR", default="")
+# recorded runs kept per city, older ones and their blobs are removed, 0 keeps all
+SNAPSHOT_KEEP = config("SNAPSHOT_KEEP", default=4, cast=int)
+# validators and content hashes of the last processed resources
+RESOURCE_STATE_PATH = config("RESOURCE_STATE_PATH", default="resource_state.json")
+# outputs of the stages of an unfinished update, resumed by the next run
+CHECKPOINT_DIR = config("CHECKPOINT_DIR", default="checkpoint")
+# new translation strings are inserted in batches of this size
+TRANSLATION_BATCH_SIZE = config("TRANSLATION_BATCH_SIZE", default=1000, cast=int)
+# facility directory, FacilitiyList.txt is converted to json on first use
+FACILITY_LIST_PATH = config("FACILITY_LIST_PATH", default="FacilitiyList.txt")
+FACILITY_DIRECTORY_PATH = config(
+    "FACILITY_DIRECTORY_PATH", default="FacilityDirectory.json"
+)
+# names are matched exactly, ignoring punctuation and stop words; templated
+# names like "Parkdale/Parkway Community Recreation Centre" are too close for
+# fuzzy matching, so it is opt-in
+FACILITY_FUZZY_MATCH = config("FACILITY_FUZZY_MATCH", default=False, cast=bool)
+FACILITY_MATCH_CUTOFF = config("FACILITY_MATCH_CUTOFF", default=0.9, cast=float)
+FACILITY_STOP_WORDS = {"a", "an", "and", "at", "of", "the"}
+# full scans of tables estimated below this many rows pass check_query_plans()
+EXPLAIN_SCAN_ROW_LIMIT = config("EXPLAIN_SCAN_ROW_LIMIT", default=1000, cast=int)
+# facility pages are scraped concurrently by this many workers
+SCRAPE_WORKERS = config("SCRAPE_WORKERS", default=8, cast=int)
+# availabilities are buffered and written in multi-row inserts of this size
+AVAILABILITY_BATCH_SIZE = config("AVAILABILITY_BATCH_SIZE", default=1000, cast=int)
+AVAILABILITY_COMMIT_PER_BATCH = config(
+    "AVAILABILITY_COMMIT_PER_BATCH", default=False, cast=bool
+)
+# rebuild availability_view at the end of every database load
+AVAILABILITY_VIEW = config("AVAILABILITY_VIEW", default=True, cast=bool)
+# connections come from a pool; transient errors are retried by replaying the
+# units written since the last commit, which happens every COMMIT_EVERY units
+DB_POOL_SIZE = config("DB_POOL_SIZE", default=4, cast=int)
+DB_RETRIES = config("DB_RETRIES", default=3, cast=int)
+DB_RETRY_DELAY = config("DB_RETRY_DELAY", default=1.0, cast=float)
+COMMIT_EVERY = config("COMMIT_EVERY", default=5000, cast=int)
+# server gone away, lost connection, lock wait timeout, deadlock
+TRANSIENT_DB_ERRORS = {2006, 2013, 2055, 1205, 1213}
+# geocoding responses are cached on disk and requested concurrently
+GEOCODE_CACHE_PATH = config("GEOCODE_CACHE_PATH", default="geocode_cache.sqlite3")
+GEOCODE_CACHE_TTL_DAYS = config("GEOCODE_CACHE_TTL_DAYS", default=90, cast=int)
+GEOCODE_WORKERS = config("GEOCODE_WORKERS", default=8, cast=int)
+# seconds to wait for another process writing to the cache
+GEOCODE_CACHE_TIMEOUT = config("GEOCODE_CACHE_TIMEOUT", default=30, cast=float)
+GEOCODE_RATE_LIMIT = config("GEOCODE_RATE_LIMIT", default=10, cast=float)
+
+# cities the scraper can run for, see getRunContext(); more cities are added in
+# CITY_CONFIG_PATH as {"name": {"city_id": ..., "resource_api": ..., ...}}
+DEFAULT_CITY = "toronto"
+CITY_CONFIG_PATH = config("CITY_CONFIG_PATH", default="cities.json")
+CITIES = {
+    DEFAULT_CITY: {
+        "city_id": 2,
+        "province": PROVINCE,
+        "resource_api": RESOURCE_API,
+        "facility_url_prefix": FACILITY_URL_PREFIX,
+    },
+}
 
 # inserting sql staments
 TRANSLATION_SQL = "INSERT INTO `translation` () VALUES();"
 LANGUAGE_TRANSLATION_SQL = "INSERT INTO `language_translation` (`TRANSLATION_ID`,`LANGUAGE_ID`, `DESCRIPTION`) VALUES (%s, %s, %s);"
+TRANSLATION_BATCH_SQL = "INSERT INTO `translation` () VALUES "
+LANGUAGE_TRANSLATION_BATCH_SQL = "INSERT INTO `language_translation` (`TRANSLATION_ID`,`LANGUAGE_ID`, `DESCRIPTION`) VALUES "
 CATEGORY_SQL = (
     "INSERT INTO `category` (`CITY_ID`, `TITLE_TRANSLATION_ID`) VALUES (%s, %s);"
 )
@@ -45,22 +192,134 @@ ACTIVITY_FACILITY_SQL = (
     "INSERT INTO `facility_activity` (`FACILITY_ID`, `ACTIVITY_ID`) VALUES (%s, %s);"
 )
 AVAILABILITY_SQL = "INSERT INTO `availability` (`FACILITY_ID`, `ACTIVITY_ID`, `START_TIME`, `END_TIME`, `MIN_AGE`, `MAX_AGE`) VALUES (%s, %s, %s, %s, %s, %s);"
+AVAILABILITY_BATCH_SQL = "INSERT INTO `availability` (`FACILITY_ID`, `ACTIVITY_ID`, `START_TIME`, `END_TIME`, `MIN_AGE`, `MAX_AGE`) VALUES "
+AVAILABILITY_VALUES_SQL = "(%s, %s, %s, %s, %s, %s)"
 ADDRESS_SQL = "INSERT INTO `address` ( `STREET_TRANSLATION_ID`, `CITY`, `PROVINCE`, `POSTAL_CODE`, `COUNTRY`, `LATITUDE`, `LONGITUDE`) VALUES (%s, %s, %s, %s, %s, %s, %s);"
 FACILITY_SQL = "INSERT INTO `facility` (`PHONE`, `ADDRESS_ID`, `TITLE_TRANSLATION_ID`, `URL`, `CITY_ID`) VALUES (%s, %s, %s, %s, %s);"
 REFERENCE_FACILITY_LOCATIONORIGIN_SQL = "INSERT INTO `reference_facility_locationorigin` (`FACILITY_ID`, `LOCATION_ID`) VALUES (%s, %s);"
 
+# bulk loading sql statements, tables and columns are listed in foreign key order
+BULK_LOAD_TABLES = [
+    ("translation", ["ID"]),
+    ("language_translation", ["TRANSLATION_ID", "LANGUAGE_ID", "DESCRIPTION"]),
+    ("address", ["ID", "STREET_TRANSLATION_ID", "CITY", "PROVINCE", "POSTAL_CODE", "COUNTRY", "LATITUDE", "LONGITUDE"]),
+    ("facility", ["ID", "PHONE", "ADDRESS_ID", "TITLE_TRANSLATION_ID", "URL", "CITY_ID"]),
+    ("reference_facility_locationorigin", ["FACILITY_ID", "LOCATION_ID"]),
+    ("category", ["ID", "CITY_ID", "TITLE_TRANSLATION_ID"]),
+    ("type", ["ID", "CATEGORY_ID", "TITLE_TRANSLATION_ID"]),
+    ("activity", ["ID", "TYPE_ID", "TITLE_TRANSLATION_ID"]),
+    ("facility_activity", ["FACILITY_ID", "ACTIVITY_ID"]),
+    ("availability", ["ID", "FACILITY_ID", "ACTIVITY_ID", "START_TIME", "END_TIME", "MIN_AGE", "MAX_AGE"]),
+]
+BULK_FOREIGN_KEYS = [
+    ("language_translation", "TRANSLATION_ID", "translation", "ID"),
+    ("address", "STREET_TRANSLATION_ID", "translation", "ID"),
+    ("facility", "ADDRESS_ID", "address", "ID"),
+    ("facility", "TITLE_TRANSLATION_ID", "translation", "ID"),
+    ("reference_facility_locationorigin", "FACILITY_ID", "facility", "ID"),
+    ("category", "TITLE_TRANSLATION_ID", "translation", "ID"),
+    ("type", "CATEGORY_ID", "category", "ID"),
+    ("type", "TITLE_TRANSLATION_ID", "translation", "ID"),
+    ("activity", "TYPE_ID", "type", "ID"),
+    ("activity", "TITLE_TRANSLATION_ID", "translation", "ID"),
+    ("facility_activity", "FACILITY_ID", "facility", "ID"),
+    ("facility_activity", "ACTIVITY_ID", "activity", "ID"),
+    ("availability", "FACILITY_ID", "facility", "ID"),
+    ("availability", "ACTIVITY_ID", "activity", "ID"),
+]
+# schema migrations, applied once per process by apply_migrations(); each
+# version lists the (table, index, columns) it adds and is never reused
+SCHEMA_MIGRATIONS = [
+    (
+        1,
+        "lookup indexes for the scraper and app read paths",
+        [
+            ("language_translation", "LANGUAGE_TRANSLATION_DESCRIPTION", ["DESCRIPTION", "LANGUAGE_ID"]),
+            ("reference_facility_locationorigin", "REFERENCE_FACILITY_LOCATIONORIGIN_LOCATION_ID", ["LOCATION_ID"]),
+            ("availability", "AVAILABILITY_FACILITY_ACTIVITY_START", ["FACILITY_ID", "ACTIVITY_ID", "START_TIME"]),
+            ("availability", "AVAILABILITY_START_TIME", ["START_TIME"]),
+            ("availability", "AVAILABILITY_END_TIME", ["END_TIME"]),
+        ],
+    ),
+    (
+        2,
+        "per-facility availability range index for the app read path",
+        [
+            ("availability", "AVAILABILITY_FACILITY_START", ["FACILITY_ID", "START_TIME"]),
+        ],
+    ),
+]
+SCHEMA_MIGRATIONS_TABLE_SQL = "CREATE TABLE IF NOT EXISTS `schema_migrations` (`VERSION` int NOT NULL, `DESCRIPTION` varchar(255) NOT NULL, `APPLIED_AT` DATETIME DEFAULT CURRENT_TIMESTAMP, PRIMARY KEY (`VERSION`)) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;"
+LOAD_SCHEMA_MIGRATIONS_SQL = "SELECT `VERSION` FROM `schema_migrations`;"
+SCHEMA_MIGRATION_SQL = "INSERT INTO `schema_migrations` (`VERSION`, `DESCRIPTION`) VALUES (%s, %s);"
+INDEX_EXISTS_SQL = "SELECT COUNT(*) FROM information_schema.`STATISTICS` WHERE `TABLE_SCHEMA` = DATABASE() AND `TABLE_NAME` = %s AND `INDEX_NAME` = %s;"
+CREATE_INDEX_SQL = "CREATE INDEX `{}` ON `{}` ({});"
+
+# read path of the app, checked by check_query_plans() along with the scraper's queries
+FIND_AVAILABILITIES_BY_FACILITY_SQL = "SELECT * FROM `availability` WHERE `FACILITY_ID` = %s AND `START_TIME` BETWEEN %s AND %s;"
+FIND_VIEW_BY_FACILITY_SQL = "SELECT * FROM `availability_view` WHERE `FACILITY_ID` = %s AND `START_TIME` BETWEEN %s AND %s;"
+
+# denormalized read model of the availabilities, rebuilt by refresh_availability_view()
+# in availability_view_new and swapped in with one RENAME TABLE
+AVAILABILITY_VIEW_TABLE_SQL = "CREATE TABLE IF NOT EXISTS `{}` (`ID` int NOT NULL AUTO_INCREMENT, `LANGUAGE_ID` char(2) NOT NULL, `FACILITY_ID` int NOT NULL, `LOCATION_ID` int NOT NULL, `FACILITY_NAME` varchar(255), `STREET` varchar(255), `CITY` varchar(45), `POSTAL_CODE` char(6), `PHONE` varchar(12), `URL` varchar(200), `LATITUDE` double, `LONGITUDE` double, `CATEGORY_ID` int NOT NULL, `CATEGORY` varchar(255) NOT NULL, `TYPE` varchar(255) NOT NULL, `ACTIVITY_ID` int NOT NULL, `ACTIVITY` varchar(255) NOT NULL, `START_TIME` DATETIME NOT NULL, `END_TIME` DATETIME, `MIN_AGE` int, `MAX_AGE` int, PRIMARY KEY (`ID`), KEY `AVAILABILITY_VIEW_FACILITY_START` (`FACILITY_ID`, `START_TIME`), KEY `AVAILABILITY_VIEW_CATEGORY_START` (`CATEGORY_ID`, `START_TIME`), KEY `AVAILABILITY_VIEW_ACTIVITY_START` (`ACTIVITY_ID`, `START_TIME`), KEY `AVAILABILITY_VIEW_START_TIME` (`START_TIME`)) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;"
+AVAILABILITY_VIEW_BATCH_SQL = "INSERT INTO `availability_view_new` (`LANGUAGE_ID`, `FACILITY_ID`, `LOCATION_ID`, `FACILITY_NAME`, `STREET`, `CITY`, `POSTAL_CODE`, `PHONE`, `URL`, `LATITUDE`, `LONGITUDE`, `CATEGORY_ID`, `CATEGORY`, `TYPE`, `ACTIVITY_ID`, `ACTIVITY`, `START_TIME`, `END_TIME`, `MIN_AGE`, `MAX_AGE`) VALUES "
+AVAILABILITY_VIEW_VALUES_SQL = "(" + ", ".join(["%s"] * 20) + ")"
+SWAP_AVAILABILITY_VIEW_SQL = "RENAME TABLE `availability_view` TO `availability_view_old`, `availability_view_new` TO `availability_view`;"
+DROP_TABLE_SQL = "DROP TABLE IF EXISTS `{}`;"
+LOAD_VIEW_FACILITIES_SQL = "SELECT `reference_facility_locationorigin`.location_id, `facility`.id, `title`.description, `street`.description, `address`.city, `address`.postal_code, `facility`.phone, `facility`.url, `address`.latitude, `address`.longitude FROM `reference_facility_locationorigin` INNER JOIN `facility` ON `reference_facility_locationorigin`.facility_id = `facility`.id INNER JOIN `address` ON `facility`.address_id = `address`.id LEFT JOIN `language_translation` `title` ON `facility`.title_translation_id = `title`.translation_id AND `title`.language_id = %s LEFT JOIN `language_translation` `street` ON `address`.street_translation_id = `street`.translation_id AND `street`.language_id = %s;"
+
+# geocode cache sql statements (sqlite)
+GEOCODE_CACHE_TABLE_SQL = "CREATE TABLE IF NOT EXISTS geocode (address TEXT PRIMARY KEY, response TEXT NOT NULL, fetched_at REAL NOT NULL);"
+FIND_GEOCODE_SQL = "SELECT response, fetched_at FROM geocode WHERE address = ?;"
+SAVE_GEOCODE_SQL = "INSERT OR REPLACE INTO geocode (address, response, fetched_at) VALUES (?, ?, ?);"
+DELETE_GEOCODE_SQL = "DELETE FROM geocode WHERE address = ?;"
+DELETE_ALL_GEOCODES_SQL = "DELETE FROM geocode;"
+DELETE_EXPIRED_GEOCODES_SQL = "DELETE FROM geocode WHERE fetched_at < ?;"
+# the cache is shared by the processes of a multi-city run
+GEOCODE_CACHE_WAL_SQL = "PRAGMA journal_mode=WAL;"
+
+LOAD_DATA_SQL = "LOAD DATA LOCAL INFILE %s INTO TABLE `{}` CHARACTER SET utf8mb4 ({});"
+AUTO_INCREMENT_SQL = "SELECT `AUTO_INCREMENT` FROM information_schema.`TABLES` WHERE `TABLE_SCHEMA` = DATABASE() AND `TABLE_NAME` = %s;"
+MAX_ID_SQL = "SELECT COALESCE(MAX(`ID`), 0) FROM `{}`;"
+FOREIGN_KEY_VIOLATIONS_SQL = "SELECT COUNT(*) FROM `{0}` LEFT JOIN `{2}` ON `{0}`.`{1}` = `{2}`.`{3}` WHERE `{2}`.`{3}` IS NULL;"
+
 # FIND_FACILITY_SQL = 'SELECT facility.id FROM `facility` INNER JOIN `translation` INNER JOIN `language_translation` WHERE decription =  %s'
 FIND_FACILITY_BY_LOCATION_ID = "SELECT `facility_id` FROM `reference_facility_locationorigin` WHERE `location_id` = %s;"
 FIND_ACTIVITY_BY_ID = "SELECT * FROM `activity` WHERE `id` = %s;"
 FIND_TYPE_BY_DESC = "SELECT * FROM `type` INNER JOIN `translation` ON `type`.title_translation_id = `translation`.id INNER JOIN `language_translation` ON `translation`.id = `language_translation`.translation_id WHERE description = %s"
+PRUNE_AVAILABILITIES_SQL = "DELETE FROM `availability` WHERE `END_TIME` < %s;"
+LOAD_AVAILABILITY_KEYS_SQL = "SELECT `ID`, `FACILITY_ID`, `ACTIVITY_ID`, `START_TIME`, `END_TIME`, `MIN_AGE`, `MAX_AGE` FROM `availability`;"
+DELETE_AVAILABILITIES_SQL = "DELETE FROM `availability` WHERE `ID` IN ({});"
 FIND_CATEGORY_BY_DESC = "SELECT * FROM `category` INNER JOIN `translation` ON `category`.title_translation_id = `translation`.id INNER JOIN `language_translation` ON `translation`.id = `language_translation`.translation_id WHERE description = %s"
 
-# global mydb
+# preloading sql statements for the dimension cache
+LOAD_FACILITIES_SQL = "SELECT `location_id`, `facility_id` FROM `reference_facility_locationorigin`;"
+LOAD_ACTIVITIES_SQL = "SELECT `id` FROM `activity`;"
+LOAD_TYPES_SQL = "SELECT `type`.id, `language_translation`.description FROM `type` INNER JOIN `language_translation` ON `type`.title_translation_id = `language_translation`.translation_id ORDER BY `type`.id;"
+LOAD_TRANSLATIONS_SQL = "SELECT `translation_id`, `language_id`, `description` FROM `language_translation` ORDER BY `translation_id`;"
+LOAD_CATEGORIES_SQL = "SELECT `category`.id, `language_translation`.description FROM `category` INNER JOIN `language_translation` ON `category`.title_translation_id = `language_translation`.translation_id ORDER BY `category`.id;"
+
+# run options, set from the command line by setuplogger()
+seed_mode = False
+bulk_load = False
+invalidate_geocodes = False
+force_update = False
+stream_dropins = False
+availability_engine = "loop"
+ingest_registered_programs = False
+replay_snapshot = None
+export_dir = None
+load_db = True
+run_cities = None
+city_workers = 0
+log_level = "debug"
+sync_mode = False
+check_plans = False
+profile_dir = None
 
 
 # primary keys for tables
 language_id = "En"
-city_id = 2
 translation_id = 0
 category_id = 0
 type_id = 0
@@ -76,106 +335,755 @@ country = "Canada"
 # facility = ''
 
 
-# row affected counting for insertions
-row_affected_traslation = 0
-row_affected_language_traslation = 0
-row_affected_facility = 0
-row_affected_categoty = 0
-row_affected_type = 0
-row_affected_activity = 0
-row_affected_availability = 0
-row_affected_address = 0
-row_affected_activity_facility = 0
-row_affected_reference_facility_locationorigin = 0
+# one pooled http session for every city of the process, see getSession()
+http_session = None
+http_session_lock = threading.Lock()
+
+# locks shared by the threads of every city
+snapshot_lock = threading.Lock()
+stats_lock = threading.Lock()
+geocode_lock = threading.Lock()
+
+# the RunContext of each thread, see runContext()
+run_local = threading.local()
+default_context = None
+
+
+# one city's run: its settings, built by getRunContext() in the driver, and all
+# the state of the run, so cities never share connections, counters or caches
+@dataclass(slots=True)
+class RunContext:
+    city: str
+    city_id: int
+    province: str
+    country: str
+    resource_api: str
+    facility_url_prefix: str
+    facility_list_path: str
+    facility_directory_path: str
+    database: str
+    resource_state_path: str
+    checkpoint_dir: str
+    stage_report_path: str
+    stage_metrics_path: str
+    export_dir: Optional[str]
+    geocode_rate_limit: float
+    # run options from the command line, a spawned worker does not inherit them
+    log_level: str
+    seed_mode: bool
+    bulk_load: bool
+    force_update: bool
+    stream_dropins: bool
+    availability_engine: str
+    ingest_registered_programs: bool
+    sync_mode: bool
+    load_db: bool
+    replay_snapshot: Optional[str]
+    profile_dir: Optional[str]
+
+    # connections, see connect_db()
+    mydb: Any = None
+    db_pool: Any = None
+    # set once apply_migrations() has brought the schema up to date
+    schema_migrated: bool = False
+    # geocode cache connection and rate limiting state, the cache file is
+    # shared by every city
+    geocode_cache: Any = None
+    geocode_next_request: float = 0.0
+    # session answering every request from replay_snapshot, see getSession()
+    replay_session: Any = None
+
+    # units of work since the last commit, replayed after a transient error
+    pending_units: list = field(default_factory=list)
+    # (cache, key) pairs added since the last commit, undone on rollback
+    cache_journal: list = field(default_factory=list)
+    # row counters as of the last commit
+    committed_rows_affected: Optional[tuple] = None
+    commit_requested: bool = False
+    # availability rows waiting for the next batched insert
+    availability_buffer: list = field(default_factory=list)
+
+    # row affected counting for insertions
+    row_affected_traslation: int = 0
+    row_affected_language_traslation: int = 0
+    row_affected_facility: int = 0
+    row_affected_categoty: int = 0
+    row_affected_type: int = 0
+    row_affected_activity: int = 0
+    row_affected_availability: int = 0
+    row_affected_address: int = 0
+    row_affected_activity_facility: int = 0
+    row_affected_reference_facility_locationorigin: int = 0
+
+    # counters sampled by stage(), stages of the current run in stage_reports
+    http_requests: int = 0
+    http_bytes: int = 0
+    db_statements: int = 0
+    stage_reports: list = field(default_factory=list)
+
+    # source files of the run, see getResources()
+    dropins: Optional[list] = None
+    facilities: Optional[list] = None
+    locations: Any = None
+    # Drop-in.json downloaded to disk when streaming, parsed by iterAvalibilities()
+    dropins_path: Optional[str] = None
+    # Registered Programs.json, always streamed, parsed by iterRegisteredPrograms()
+    programs_path: Optional[str] = None
+    # resources whose content changed since the last successful run, and the
+    # state to persist once the run succeeds
+    changed_resources: set = field(default_factory=set)
+    pending_resource_state: dict = field(default_factory=dict)
+
+    # checkpoint of the current update, see beginCheckpoint()
+    checkpoint: Optional[dict] = None
+    # availabilities handed to the database so far, committed ones are recorded
+    # as the checkpoint's watermark by commit_units()
+    availability_position: int = 0
+    # availabilities that ended by this time are not extracted; one update uses
+    # the same cutoff for every pass, and a resumed one the cutoff of its checkpoint
+    availability_cutoff: Optional[datetime] = None
+
+    # snapshot of the current run, see beginSnapshot()
+    snapshot_run_dir: Optional[str] = None
+    snapshot_manifest: dict = field(default_factory=dict)
+
+    # facility directory entries keyed by normalized name, see loadFacilityDirectory()
+    facility_directory: Optional[dict] = None
+    facility_directory_words: Optional[dict] = None
+    facility_directory_mtime: Optional[float] = None
+    # facilities from the Locations file keyed by location id, see getFacilityIndex()
+    facility_index: Optional[dict] = None
+
+    # dimension cache, loaded once per run by load_dimension_cache()
+    category_cache: Optional[dict] = None
+    type_cache: Optional[dict] = None
+    activity_cache: Optional[dict] = None
+    facility_cache: Optional[dict] = None
+    # (language, description) -> translation id, see load_translation_cache()
+    translation_cache: Optional[dict] = None
+    # (category id, type) -> type id, types created while seeding
+    seed_type_cache: Optional[dict] = None
+    cache_hits: int = 0
+    cache_misses: int = 0
+
+
+# rows passed between the pipeline stages, slotted to keep large runs compact
+@dataclass(slots=True)
+class Availability:
+    start_time: str
+    end_time: str
+    category: str
+    location_id: int
+    course_id: int
+    course_title: str
+    type: str
+    age_min: Optional[int] = None
+    age_max: Optional[int] = None
+
+
+@dataclass(slots=True)
+class Facility:
+    location_id: int
+    facility_name: str
+    city: str
+    street: str
+    province: str
+    postal_code: str
+    phone: Optional[str] = None
+    url: Optional[str] = None
+    lat: Optional[float] = None
+    lng: Optional[float] = None
+    facility_id: Optional[int] = None
 
 
 def getResources():
+    # returns True once every changed resource has been downloaded
+    context = runContext()
     params = {"key": "value"}
-    global dropins, facilities, locations, registeredPrograms
-    logger.info("Requesting resources from City of Toronto OpenAPI: " + RESOURCE_API)
+    logger.info("Requesting resources from City of Toronto OpenAPI: " + context.resource_api)
     try:
-        r = requests.get(url=RESOURCE_API, params=params)
+        r = getSession().get(url=context.resource_api, params=params, timeout=HTTP_TIMEOUT)
         response = r.json()
     except (ConnectionError, Exception) as e:
-        logger.warning(("Could not get resources from {}:".format(RESOURCE_API)))
+        logger.warning(("Could not get resources from {}:".format(context.resource_api)))
         logger.warning(e)
 
     try:
-        resources = response["result"]["resources"]
-        resources_dict = {}
-        for resource in resources:
+        # a replay reprocesses everything in its snapshot
+        if context.force_update or context.seed_mode or context.replay_snapshot is not None:
+            state = {}
+        else:
+            state = loadResourceState()
+        context.changed_resources = set()
+        context.pending_resource_state = dict(state)
+        removeStreamedFiles()
+        context.dropins = None
+        context.facilities = None
+        context.locations = None
+        context.facility_index = None
+
+        # resources whose CKAN metadata is unchanged are not requested at all
+        ingested = ingestedResources()
+        resources = []
+        for resource in response["result"]["resources"]:
             name = resource["name"]
-            url = resource["url"]
-
-            if resource["name"] in [DROPIN, FACILITIES, REGISTERED_PROGRAMS]:
-                logger.info("Getting source file: " + resource["name"])
-                content = requests.get(url=url, params=params).json()
-                resources_dict[name] = content
-            elif resource["name"] == LOCATIONS:
-                logger.info("Getting source file: " + resource["name"])
-                csv = requests.get(url=url, params=params).content
-                locations = pd.read_csv(
-                    io.StringIO(csv.decode("utf-8")), sep=",", header=0
+            if name not in ingested + [FACILITIES, LOCATIONS]:
+                continue
+            previous = state.get(name)
+            if (
+                previous is not None
+                and resource.get("last_modified") is not None
+                and previous.get("ckan_last_modified") == resource["last_modified"]
+            ):
+                logger.info("Source file unchanged since last run: " + name)
+                continue
+            resources.append(resource)
+
+        # locations are always needed to process changed drop-ins, and drop-ins
+        # and registered programs are always processed together
+        headers = {}
+        names = [resource["name"] for resource in resources]
+        if any(name in names for name in ingested):
+            for resource in response["result"]["resources"]:
+                name = resource["name"]
+                if name == LOCATIONS or (len(ingested) > 1 and name in ingested):
+                    if name not in names:
+                        resources.append(resource)
+                        names.append(name)
+                    headers[name] = {}
+        for resource in resources:
+            if resource["name"] not in headers:
+                headers[resource["name"]] = conditionalHeaders(
+                    state.get(resource["name"])
+                )
+
+        # drop-ins are spooled to disk instead of memory when streaming
+        paths = {}
+        if context.stream_dropins and DROPIN in headers:
+            fp = tempfile.NamedTemporaryFile(
+                prefix="dropins_", suffix=".json", delete=False
+            )
+            fp.close()
+            context.dropins_path = paths[DROPIN] = fp.name
+        if REGISTERED_PROGRAMS in headers:
+            fp = tempfile.NamedTemporaryFile(
+                prefix="programs_", suffix=".json", delete=False
+            )
+            fp.close()
+            context.programs_path = paths[REGISTERED_PROGRAMS] = fp.name
+
+        resources_dict = {}
+        for name, r, sha256 in fetchResources(resources, headers, paths):
+            resource = next(res for res in resources if res["name"] == name)
+            previous = state.get(name, {})
+            if r.status_code == 304:
+                logger.info("Source file not modified: " + name)
+                context.pending_resource_state[name] = dict(
+                    previous, ckan_last_modified=resource.get("last_modified")
+                )
+                continue
+
+            context.pending_resource_state[name] = {
+                "etag": r.headers.get("ETag"),
+                "last_modified": r.headers.get("Last-Modified"),
+                "ckan_last_modified": resource.get("last_modified"),
+                "sha256": sha256,
+            }
+            if sha256 != previous.get("sha256"):
+                context.changed_resources.add(name)
+                logger.info("Got changed source file: " + name)
+            else:
+                logger.info("Got unchanged source file: " + name)
+
+            if name in paths:
+                continue
+            elif name == LOCATIONS:
+                context.locations = pd.read_csv(
+                    io.StringIO(r.content.decode("utf-8")), sep=",", header=0
                 )
                 # fill NaN values with ''
-                locations = locations.fillna("")
+                context.locations = context.locations.fillna("")
+            else:
+                resources_dict[name] = json.loads(r.content)
 
-        dropins = resources_dict[DROPIN]
-        facilities = resources_dict[FACILITIES]
-        registeredPrograms = resources_dict[REGISTERED_PROGRAMS]
+        context.dropins = resources_dict.get(DROPIN)
+        context.facilities = resources_dict.get(FACILITIES)
+        return True
+    except Exception as e:
+        logger.warning(e)
+        return False
+
+
+def conditionalHeaders(previous):
+    headers = {}
+    if previous is not None:
+        if previous.get("etag"):
+            headers["If-None-Match"] = previous["etag"]
+        if previous.get("last_modified"):
+            headers["If-Modified-Since"] = previous["last_modified"]
+    return headers
+
+
+def loadResourceState():
+    context = runContext()
+    if not os.path.exists(context.resource_state_path):
+        return {}
+    with open(context.resource_state_path) as fp:
+        return json.load(fp)
+
+
+def saveResourceState():
+    context = runContext()
+    with open(context.resource_state_path, "w") as fp:
+        json.dump(context.pending_resource_state, fp, indent=2)
+    logger.info("Saved resource state to " + context.resource_state_path)
+
+
+def beginCheckpoint():
+    # resumes the checkpoint of a failed update of the same resources, or starts
+    # a new one
+    context = runContext()
+    context.checkpoint = None
+    context.availability_position = 0
+    if context.checkpoint_dir == "" or context.replay_snapshot is not None:
+        return
+    fingerprint = {
+        "resources": {
+            name: context.pending_resource_state.get(name, {}).get("sha256")
+            for name in ingestedResources() + [LOCATIONS]
+        },
+        "stream": context.stream_dropins,
+    }
+    previous = None
+    try:
+        with open(os.path.join(context.checkpoint_dir, "checkpoint.json")) as fp:
+            previous = json.load(fp)
+    except FileNotFoundError:
+        pass
     except Exception as e:
         logger.warning(e)
 
+    if (
+        previous is not None
+        and previous.get("fingerprint") == fingerprint
+        and "cutoff" in previous
+    ):
+        context.checkpoint = previous
+        context.availability_position = context.checkpoint["availabilities"]
+        # the watermark counts positions in the availabilities extracted with
+        # this cutoff, so the resumed run extracts the same ones
+        context.availability_cutoff = datetime.fromisoformat(context.checkpoint["cutoff"])
+        logger.info(
+            "Resuming from checkpoint after stages: "
+            + ", ".join(context.checkpoint["stages"])
+            + ", "
+            + str(context.availability_position)
+            + " availabilities stored"
+        )
+    else:
+        clearCheckpoint()
+        os.makedirs(context.checkpoint_dir, exist_ok=True)
+        context.checkpoint = {
+            "fingerprint": fingerprint,
+            "cutoff": availabilityCutoff().isoformat(),
+            "stages": [],
+            "availabilities": 0,
+        }
+
+
+def checkpointed(name):
+    context = runContext()
+    return context.checkpoint is not None and name in context.checkpoint["stages"]
+
+
+def saveCheckpoint(name, **outputs):
+    # pickles the outputs of a completed stage, then records the stage
+    context = runContext()
+    if context.checkpoint is None:
+        return
+    try:
+        for key, value in outputs.items():
+            if value is None:
+                continue
+            path = os.path.join(context.checkpoint_dir, key + ".pickle")
+            with open(path + ".tmp", "wb") as fp:
+                pickle.dump(value, fp, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(path + ".tmp", path)
+        if name not in context.checkpoint["stages"]:
+            context.checkpoint["stages"].append(name)
+        writeCheckpoint()
+        logger.info("Checkpointed stage " + name)
+    except Exception as e:
+        logger.warning(e)
 
-def getAvalibilities():
-    logger.info("Extracting avalibilities from file: " + DROPIN)
+
+def writeCheckpoint():
+    context = runContext()
+    path = os.path.join(context.checkpoint_dir, "checkpoint.json")
+    with open(path + ".tmp", "w") as fp:
+        json.dump(context.checkpoint, fp, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def loadCheckpoint(key):
+    context = runContext()
+    logger.info("Restoring " + key + " from checkpoint")
+    with open(os.path.join(context.checkpoint_dir, key + ".pickle"), "rb") as fp:
+        return pickle.load(fp)
+
+
+def clearCheckpoint():
+    context = runContext()
+    context.checkpoint = None
+    if context.checkpoint_dir != "":
+        shutil.rmtree(context.checkpoint_dir, ignore_errors=True)
+
+
+def getSession():
+    # every city of the process shares one pooled session, a replay answers
+    # from its own snapshot instead
+    global http_session
+    context = runContext()
+    if context.replay_snapshot is not None:
+        if context.replay_session is None:
+            context.replay_session = newSession(SnapshotAdapter(context.replay_snapshot))
+        return context.replay_session
+    with http_session_lock:
+        if http_session is None:
+            retry = Retry(
+                total=HTTP_RETRIES,
+                backoff_factor=HTTP_BACKOFF,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=["GET"],
+            )
+            http_session = newSession(
+                HTTPAdapter(
+                    pool_connections=HTTP_POOL_SIZE,
+                    pool_maxsize=HTTP_POOL_SIZE,
+                    max_retries=retry,
+                )
+            )
+    return http_session
+
+
+def newSession(adapter):
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    # the hooks count and record for the context of the requesting thread
+    session.hooks["response"].append(count_http_response)
+    session.hooks["response"].append(record_snapshot_response)
+    return session
+
+
+def resetSession():
+    # a forked city worker must not reuse the connections of its parent
+    global http_session
+    http_session = None
+
+
+os.register_at_fork(after_in_child=resetSession)
+
+
+def fetchResources(resources, headers=None, paths=None):
+    # yields (name, response, sha256) for each resource as soon as its download
+    # finishes, resources with a path in paths are written to that file
+    session = getSession()
+    if headers is None:
+        headers = {}
+    if paths is None:
+        paths = {}
+    with cityThreadPool(HTTP_POOL_SIZE) as executor:
+        futures = {}
+        for resource in resources:
+            logger.info("Getting source file: " + resource["name"])
+            future = executor.submit(
+                fetchResource,
+                session,
+                resource["url"],
+                headers.get(resource["name"], {}),
+                paths.get(resource["name"]),
+            )
+            futures[future] = resource["name"]
+        for future in as_completed(futures):
+            r, sha256 = future.result()
+            yield futures[future], r, sha256
+
+
+def fetchResource(session, url, headers, path=None):
+    if path is None:
+        r = session.get(url=url, headers=headers, timeout=HTTP_TIMEOUT)
+        r.raise_for_status()
+        return r, hashlib.sha256(r.content).hexdigest()
+
+    sha256 = hashlib.sha256()
+    with session.get(url=url, headers=headers, timeout=HTTP_TIMEOUT, stream=True) as r:
+        r.raise_for_status()
+        with open(path, "wb") as fp:
+            for chunk in r.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                count_http_bytes(len(chunk))
+                sha256.update(chunk)
+                fp.write(chunk)
+    snapshotFile(snapshotUrl(r), r, path, sha256.hexdigest())
+    return r, sha256.hexdigest()
+
+
+def count_http_response(r, *args, **kwargs):
+    context = runContext()
+    with stats_lock:
+        context.http_requests += 1
+    # streamed bodies are counted as they are read
+    if not kwargs.get("stream"):
+        count_http_bytes(len(r.content))
+
+
+def count_http_bytes(n):
+    context = runContext()
+    with stats_lock:
+        context.http_bytes += n
+
+
+def beginSnapshot():
+    # each recorded run gets a manifest of its responses, their bodies are
+    # stored once in a content-addressed blob directory shared by all runs
+    context = runContext()
+    context.snapshot_manifest.clear()
+    context.snapshot_run_dir = None
+    if SNAPSHOT_DIR == "" or context.replay_snapshot is not None:
+        return
+    name = datetime.now().strftime("%Y%m%dT%H%M%S")
+    if context.city != DEFAULT_CITY:
+        name += "-" + context.city
+    context.snapshot_run_dir = os.path.join(SNAPSHOT_DIR, name)
+    os.makedirs(context.snapshot_run_dir, exist_ok=True)
+    logger.info("Recording snapshot to " + context.snapshot_run_dir)
+
+
+def saveSnapshot():
+    context = runContext()
+    if context.snapshot_run_dir is None:
+        return
     try:
-        availabilities = []
-        for dropin in dropins:
-            availability = {}
-            availability["start_time"] = dropin["Start Date Time"]
-            startDatetime = datetime.strptime(
-                dropin["Start Date Time"], "%Y-%m-%dT%H:%M:%S"
+        with snapshot_lock:
+            manifest = dict(context.snapshot_manifest)
+        with open(os.path.join(context.snapshot_run_dir, "manifest.json"), "w") as fp:
+            json.dump(manifest, fp, indent=2)
+        logger.info(
+            "Saved " + str(len(manifest)) + " responses to snapshot " + context.snapshot_run_dir
+        )
+    except Exception as e:
+        logger.warning(e)
+
+
+def pruneSnapshots():
+    # runs after every city is done, so no run is still writing blobs
+    if SNAPSHOT_DIR == "" or SNAPSHOT_KEEP <= 0 or not os.path.isdir(SNAPSHOT_DIR):
+        return
+    try:
+        # run names are a timestamp, followed by "-" and the city for other cities
+        runs = {}
+        for name in sorted(os.listdir(SNAPSHOT_DIR)):
+            if re.fullmatch(r"\d{8}T\d{6}(-.+)?", name) is not None:
+                runs.setdefault(name[15:], []).append(name)
+        referenced = set()
+        for names in runs.values():
+            for name in names[:-SNAPSHOT_KEEP]:
+                shutil.rmtree(os.path.join(SNAPSHOT_DIR, name))
+                logger.info("Removed snapshot " + name)
+            for name in names[-SNAPSHOT_KEEP:]:
+                manifest_path = os.path.join(SNAPSHOT_DIR, name, "manifest.json")
+                if os.path.exists(manifest_path):
+                    with open(manifest_path) as fp:
+                        referenced.update(entry["blob"] for entry in json.load(fp).values())
+        removed = 0
+        for root, dirs, files in os.walk(os.path.join(SNAPSHOT_DIR, "blobs")):
+            for file in files:
+                if file.split(".")[0] not in referenced:
+                    os.remove(os.path.join(root, file))
+                    removed += 1
+        if removed != 0:
+            logger.info("Removed " + str(removed) + " snapshot blobs no run uses")
+    except Exception as e:
+        logger.warning(e)
+
+
+def snapshotKey(url):
+    # the API key is not part of the key and never written to the manifest
+    parts = urlsplit(url)
+    query = sorted(
+        (name, value)
+        for name, value in parse_qsl(parts.query, keep_blank_values=True)
+        if name != "key"
+    )
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query), ""))
+
+
+def snapshotUrl(r):
+    # the url that was asked for, before any redirect
+    if len(r.history) != 0:
+        return r.history[0].request.url
+    return r.request.url
+
+
+def snapshotBlobPath(blobs_dir, sha256):
+    extension = ".zst" if zstandard is not None else ".gz"
+    return os.path.join(blobs_dir, sha256[:2], sha256 + extension)
+
+
+def record_snapshot_response(r, *args, **kwargs):
+    # streamed bodies are recorded by fetchResource once they are on disk
+    context = runContext()
+    if context.snapshot_run_dir is None or kwargs.get("stream") or r.status_code != 200:
+        return
+    snapshotContent(snapshotUrl(r), r.status_code, r.headers, r.content)
+
+
+def snapshotContent(url, status, headers, content):
+    sha256 = hashlib.sha256(content).hexdigest()
+    try:
+        if zstandard is not None:
+            storeSnapshotBlob(
+                sha256, lambda fp: fp.write(zstandard.ZstdCompressor().compress(content))
             )
-            endHour = dropin["End Hour"]
-            endMin = dropin["End Min"]
-            endDatetime = startDatetime.replace(hour=endHour, minute=endMin)
-            endDatetimeStr = endDatetime.strftime("%Y-%m-%dT%H:%M:%S")
-            
-            if datetime.strptime(endDatetimeStr, "%Y-%m-%dT%H:%M:%S") > datetime.now():
-                availability["end_time"] = endDatetimeStr
-
-                availability["category"] = dropin["Category"]
-                availability["location_id"] = dropin["Location ID"]
-                availability["course_id"] = dropin["Course_ID"]
-                availability["course_title"] = dropin["Course Title"]
-                if ":" in availability["course_title"]:
-                    type = availability["course_title"].split(":")[0].strip()
-                elif "(" in availability["course_title"]:
-                    type = availability["course_title"].split("(")[0].strip()
-                elif "-" in availability["course_title"]:
-                    type = availability["course_title"].split("-")[0].strip()
-                else:
-                    type = availability["course_title"]
-                availability["type"] = type
-                if dropin["Age Min"] != "None":
-                    availability["age_min"] = dropin["Age Min"]
-                else:
-                    availability["age_min"] = None
+        else:
+            storeSnapshotBlob(sha256, lambda fp: fp.write(gzip.compress(content)))
+        addSnapshotEntry(url, status, headers, sha256)
+    except Exception as e:
+        logger.warning("Could not record " + url + " in snapshot: " + str(e))
 
-                if dropin["Age Max"] != "None":
-                    availability["age_max"] = dropin["Age Max"]
-                else:
-                    availability["age_max"] = None
 
-                availabilities.append(availability)
+def snapshotFile(url, r, path, sha256):
+    context = runContext()
+    if context.snapshot_run_dir is None:
+        return
+
+    def compress(fp):
+        with open(path, "rb") as src:
+            if zstandard is not None:
+                zstandard.ZstdCompressor().copy_stream(src, fp)
+            else:
+                with gzip.GzipFile(fileobj=fp, mode="wb") as gz:
+                    shutil.copyfileobj(src, gz, STREAM_CHUNK_SIZE)
+
+    try:
+        storeSnapshotBlob(sha256, compress)
+        addSnapshotEntry(url, r.status_code, r.headers, sha256)
+    except Exception as e:
+        logger.warning("Could not record " + url + " in snapshot: " + str(e))
+
+
+def storeSnapshotBlob(sha256, write):
+    # blobs never change once written, write(fp) writes the compressed body
+    blob = snapshotBlobPath(os.path.join(SNAPSHOT_DIR, "blobs"), sha256)
+    if os.path.exists(blob):
+        return
+    os.makedirs(os.path.dirname(blob), exist_ok=True)
+    # the blobs are shared by the processes of a multi-city run
+    tmp = blob + ".tmp" + str(os.getpid()) + "-" + str(threading.get_ident())
+    with open(tmp, "wb") as fp:
+        write(fp)
+    os.replace(tmp, blob)
+
+
+def addSnapshotEntry(url, status, headers, sha256):
+    context = runContext()
+    entry = {
+        "status": status,
+        "headers": {
+            name: headers[name]
+            for name in ["Content-Type", "ETag", "Last-Modified"]
+            if name in headers
+        },
+        "blob": sha256,
+    }
+    with snapshot_lock:
+        context.snapshot_manifest[snapshotKey(url)] = entry
+
+
+def loadSnapshot(snapshot):
+    # returns (manifest, blob directory) of a run directory or a run under SNAPSHOT_DIR
+    run_dir = snapshot
+    if not os.path.isdir(run_dir):
+        run_dir = os.path.join(SNAPSHOT_DIR, snapshot)
+    with open(os.path.join(run_dir, "manifest.json")) as fp:
+        manifest = json.load(fp)
+    blobs_dir = os.path.join(os.path.dirname(os.path.abspath(run_dir)), "blobs")
+    return manifest, blobs_dir
+
+
+def openSnapshotBlob(blobs_dir, sha256):
+    path = os.path.join(blobs_dir, sha256[:2], sha256 + ".zst")
+    if os.path.exists(path):
+        if zstandard is None:
+            raise RuntimeError("zstandard is needed to replay " + path)
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+    return gzip.open(os.path.join(blobs_dir, sha256[:2], sha256 + ".gz"), "rb")
+
+
+class SnapshotAdapter(HTTPAdapter):
+    # answers every request from a recorded snapshot instead of the network
+    def __init__(self, snapshot):
+        super().__init__()
+        self.manifest, self.blobs_dir = loadSnapshot(snapshot)
+
+    def send(self, request, stream=False, **kwargs):
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+        entry = self.manifest.get(snapshotKey(request.url))
+        if entry is None:
+            logger.warning("Not in snapshot: " + snapshotKey(request.url))
+            response.status_code = 404
+            response.raw = io.BytesIO(b"")
+        else:
+            response.status_code = entry["status"]
+            response.headers.update(entry["headers"])
+            response.raw = openSnapshotBlob(self.blobs_dir, entry["blob"])
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.reason = HTTPStatus(response.status_code).phrase
+        return response
+
+
+def ingestedResources():
+    # resources whose rows end up in the availability table
+    context = runContext()
+    if context.ingest_registered_programs:
+        return [DROPIN, REGISTERED_PROGRAMS]
+    return [DROPIN]
+
+
+def removeStreamedFiles():
+    context = runContext()
+    for path in [context.dropins_path, context.programs_path]:
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+    context.dropins_path = None
+    context.programs_path = None
+
+
+def getAvalibilities():
+    context = runContext()
+    if context.availability_engine == "pandas" and context.dropins is not None:
+        return getAvalibilitiesVectorized()
+
+    logger.info("Extracting avalibilities from file: " + DROPIN)
+    try:
+        availabilities = []
+        now = availabilityCutoff()
+        if context.dropins is None and context.dropins_path is not None:
+            availabilities = list(iterAvalibilities())
+        else:
+            for dropin in context.dropins:
+                availability = getAvailability(dropin, now)
+                if availability is not None:
+                    availabilities.append(availability)
         availabilities = sorted(
             availabilities,
             key=lambda x: (
-                x["category"],
-                x["type"],
-                x["course_title"],
-                x["location_id"],
+                x.category,
+                x.type,
+                x.course_title,
+                x.location_id,
             ),
         )
         return availabilities
@@ -183,91 +1091,484 @@ def getAvalibilities():
         logger.warning(e)
 
 
-def getOriginalFacilities(availablities):
-    logger.info("Extracting facilities original data from file: " + LOCATIONS)
+def getAvalibilitiesVectorized():
+    context = runContext()
+    logger.info("Extracting avalibilities from file with pandas: " + DROPIN)
     try:
-        locationList = locations.filter(
-            items=[
+        df = pd.DataFrame.from_records(
+            context.dropins,
+            columns=[
+                "Start Date Time",
+                "End Hour",
+                "End Min",
+                "Category",
                 "Location ID",
-                "Location Name",
-                "District",
-                "Street No",
-                "Street No Suffix",
-                "Street Name",
-                "Street Type",
-                "Postal Code",
-            ]
-        ).values.tolist()
+                "Course_ID",
+                "Course Title",
+                "Age Min",
+                "Age Max",
+            ],
+        )
+        startDatetime = pd.to_datetime(df["Start Date Time"], format="%Y-%m-%dT%H:%M:%S")
+        endDatetime = (
+            startDatetime.dt.normalize()
+            + pd.to_timedelta(df["End Hour"].astype("int64"), unit="h")
+            + pd.to_timedelta(df["End Min"].astype("int64"), unit="m")
+            + pd.to_timedelta(startDatetime.dt.second, unit="s")
+        )
+        future = (endDatetime > availabilityCutoff()).to_numpy()
+        df = df[future]
+        endDatetime = endDatetime[future]
+
+        # titles repeat heavily, so types are derived once per distinct title
+        codes, titles = pd.factorize(df["Course Title"])
+        types = np.array([getType(title) for title in titles], dtype=object)[codes]
+
+        availabilities = pd.DataFrame(
+            {
+                "start_time": df["Start Date Time"].to_numpy(dtype=object),
+                "end_time": np.datetime_as_string(
+                    endDatetime.to_numpy(dtype="datetime64[s]"), unit="s"
+                ).astype(object),
+                "category": df["Category"].to_numpy(dtype=object),
+                "location_id": df["Location ID"].to_numpy(),
+                "course_id": df["Course_ID"].to_numpy(),
+                "course_title": df["Course Title"].to_numpy(dtype=object),
+                "type": types,
+                "age_min": df["Age Min"].astype(object).where(df["Age Min"] != "None", None).to_numpy(),
+                "age_max": df["Age Max"].astype(object).where(df["Age Max"] != "None", None).to_numpy(),
+            }
+        )
+        availabilities = availabilities.sort_values(
+            ["category", "type", "course_title", "location_id"], kind="stable"
+        )
+        # build the records from plain lists, the columns are in field order
+        return [
+            Availability(*row)
+            for row in zip(
+                *(availabilities[column].tolist() for column in availabilities.columns)
+            )
+        ]
+    except Exception as e:
+        logger.warning(e)
+
 
+def iterAvalibilities():
+    # yields future availabilities from the streamed Drop-in.json, unsorted
+    context = runContext()
+    logger.info("Streaming avalibilities from file: " + DROPIN)
+    now = availabilityCutoff()
+    with open(context.dropins_path, "rb") as fp:
+        if ijson is None:
+            logger.warning("ijson is not installed, loading " + DROPIN + " at once")
+            items = json.load(fp)
+        else:
+            items = ijson.items(fp, "item", buf_size=STREAM_CHUNK_SIZE)
+        for dropin in items:
+            availability = getAvailability(dropin, now)
+            if availability is not None:
+                yield availability
+
+
+def availabilityCutoff():
+    context = runContext()
+    if context.availability_cutoff is None:
+        return datetime.now()
+    return context.availability_cutoff
+
+
+def withoutEnded(availabilities):
+    # leaves out availabilities that ended since they were extracted, lists
+    # stay lists and streams stay streams
+    now = datetime.now()
+    if isinstance(availabilities, list):
+        return [
+            availability
+            for availability in availabilities
+            if not hasEnded(availability, now)
+        ]
+    return (
+        availability for availability in availabilities if not hasEnded(availability, now)
+    )
+
+
+def hasEnded(availability, now):
+    return availability.end_time <= now.strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def getAvailability(dropin, now):
+    # returns None for drop-ins that have already ended
+    startDatetime = datetime.strptime(dropin["Start Date Time"], "%Y-%m-%dT%H:%M:%S")
+    endHour = dropin["End Hour"]
+    endMin = dropin["End Min"]
+    endDatetime = startDatetime.replace(hour=int(endHour), minute=int(endMin))
+    if endDatetime <= now:
+        return None
+
+    ageMin = dropin["Age Min"]
+    if ageMin == "None":
+        ageMin = None
+    ageMax = dropin["Age Max"]
+    if ageMax == "None":
+        ageMax = None
+    return Availability(
+        start_time=dropin["Start Date Time"],
+        end_time=endDatetime.strftime("%Y-%m-%dT%H:%M:%S"),
+        category=dropin["Category"],
+        location_id=dropin["Location ID"],
+        course_id=dropin["Course_ID"],
+        course_title=dropin["Course Title"],
+        type=getType(dropin["Course Title"]),
+        age_min=ageMin,
+        age_max=ageMax,
+    )
+
+
+def withRegisteredPrograms(availabilities):
+    # appends the registered programs to the drop-in availabilities when they
+    # are ingested, lists stay lists and streams stay streams
+    context = runContext()
+    if not context.ingest_registered_programs or context.programs_path is None:
+        return availabilities
+    if isinstance(availabilities, list):
+        return availabilities + list(iterRegisteredPrograms())
+    return itertools.chain(availabilities, iterRegisteredPrograms())
+
+
+def iterRegisteredPrograms():
+    # yields a future availability for every meeting of every registered program
+    context = runContext()
+    logger.info("Streaming registered programs from file: " + REGISTERED_PROGRAMS)
+    now = availabilityCutoff()
+    with open(context.programs_path, "rb") as fp:
+        if ijson is None:
+            logger.warning(
+                "ijson is not installed, loading " + REGISTERED_PROGRAMS + " at once"
+            )
+            items = json.load(fp)
+        else:
+            items = ijson.items(fp, "item", buf_size=STREAM_CHUNK_SIZE)
+        for program in items:
+            try:
+                for availability in getProgramAvailabilities(program, now):
+                    yield availability
+            except (KeyError, TypeError, ValueError) as e:
+                logger.warning(
+                    "Could not read registered program "
+                    + str(program.get("Course_ID"))
+                    + ": "
+                    + str(e)
+                )
+
+
+def getProgramAvailabilities(program, now):
+    # a program meets on the given days of the week between its start and end date
+    startDate = datetime.strptime(program["Start Date"][:10], "%Y-%m-%d")
+    endDate = datetime.strptime(program["End Date"][:10], "%Y-%m-%d")
+    days = getWeekdays(program["Days of The Week"])
+    ageMin = program["Age Min"]
+    if ageMin == "None":
+        ageMin = None
+    ageMax = program["Age Max"]
+    if ageMax == "None":
+        ageMax = None
+
+    date = startDate
+    while date <= endDate:
+        if date.weekday() in days:
+            startDatetime = date.replace(
+                hour=int(program["Start Hour"]), minute=int(program["Start Min"])
+            )
+            endDatetime = date.replace(
+                hour=int(program["End Hour"]), minute=int(program["End Min"])
+            )
+            if endDatetime > now:
+                yield Availability(
+                    start_time=startDatetime.strftime("%Y-%m-%dT%H:%M:%S"),
+                    end_time=endDatetime.strftime("%Y-%m-%dT%H:%M:%S"),
+                    category=program["Program Category"],
+                    location_id=int(program["Location ID"]),
+                    course_id=int(program["Course_ID"]),
+                    course_title=program["Course Title"],
+                    type=getType(program["Course Title"]),
+                    age_min=ageMin,
+                    age_max=ageMax,
+                )
+        date += timedelta(days=1)
+
+
+def getWeekdays(days):
+    # "Mon, Wed", "Tu Th", "M W F" or "Weekends" -> {0, 2}, {1, 3}, {0, 2, 4}
+    # or {5, 6}; raises ValueError when the days are missing or not recognised
+    weekdays = set()
+    for day in re.findall(r"[A-Za-z]+", days or ""):
+        day = day.casefold()
+        if day == "and":
+            continue
+        if day in WEEKDAYS:
+            weekdays.update(WEEKDAYS[day])
+        elif all(letter in WEEKDAY_LETTERS for letter in day):
+            weekdays.update(WEEKDAY_LETTERS[letter] for letter in day)
+        else:
+            raise ValueError("unknown days of the week: " + str(days))
+    if len(weekdays) == 0:
+        raise ValueError("no days of the week: " + str(days))
+    return weekdays
+
+
+def getType(course_title):
+    if ":" in course_title:
+        return course_title.split(":")[0].strip()
+    elif "(" in course_title:
+        return course_title.split("(")[0].strip()
+    elif "-" in course_title:
+        return course_title.split("-")[0].strip()
+    return course_title
+
+
+def getOriginalFacilities(availablities):
+    logger.info("Extracting facilities original data from file: " + LOCATIONS)
+    try:
         locationIDs = set()
         facilitiesNoGeo = []
 
         for availablity in availablities:
-            locationID = availablity["location_id"]
+            locationID = availablity.location_id
             locationIDs.add(locationID)
 
         for locationID in locationIDs:
-            for locat in locationList:
-                if locationID == locat[0]:
-                    street = (
-                        str(locat[3])
-                        + str(locat[4])
-                        + " "
-                        + str(locat[5])
-                        + " "
-                        + str(locat[6])
-                    )
-                    facilitiesNoGeo.append(
-                        {
-                            "location_id": locat[0],
-                            "facility_name": locat[1],
-                            "city": locat[2],
-                            "street": street,
-                            "province": PROVINCE,
-                            "postal_code": locat[7],
-                            "phone": None,
-                            "url": None,
-                        }
-                    )
+            facility = lookupFacility(locationID)
+            if facility is not None:
+                facilitiesNoGeo.append(facility)
 
         return facilitiesNoGeo
     except Exception as e:
         logger.warning(e)
 
 
-def getGeoToFacilities(facilities):
+def getFacilityIndex():
+    context = runContext()
+    if context.facility_index is None:
+        context.facility_index = buildFacilityIndex()
+    return context.facility_index
+
+
+def buildFacilityIndex():
+    context = runContext()
+    logger.info("Indexing facilities from file: " + LOCATIONS)
+    locationList = context.locations.filter(
+        items=[
+            "Location ID",
+            "Location Name",
+            "District",
+            "Street No",
+            "Street No Suffix",
+            "Street Name",
+            "Street Type",
+            "Postal Code",
+        ]
+    ).drop_duplicates(subset="Location ID")
+    street = (
+        locationList["Street No"].astype(str)
+        + locationList["Street No Suffix"].astype(str)
+        + " "
+        + locationList["Street Name"].astype(str)
+        + " "
+        + locationList["Street Type"].astype(str)
+    )
+
+    index = {}
+    for locationID, name, district, streetStr, postalCode in zip(
+        locationList["Location ID"].tolist(),
+        locationList["Location Name"].tolist(),
+        locationList["District"].tolist(),
+        street.tolist(),
+        locationList["Postal Code"].tolist(),
+    ):
+        index[locationID] = Facility(
+            location_id=locationID,
+            facility_name=name,
+            city=district,
+            street=streetStr,
+            province=context.province,
+            postal_code=postalCode,
+        )
+    logger.info("Indexed " + str(len(index)) + " facilities")
+    return index
+
+
+def lookupFacility(location_id):
+    # returns a copy, later stages add coordinates, phone numbers and urls
+    facility = getFacilityIndex().get(location_id)
+    if facility is None:
+        return None
+    return replace(facility)
+
+
+def getGeoToFacilities(facilities, geocoder=None):
+    context = runContext()
     logger.info("Start getting coordinations for facilities...")
+    if geocoder is None:
+        geocoder = requestGeocode
     try:
+        open_geocode_cache()
         facilities_geo = []
+        pending = {}
         for facility in facilities:
-            facilities_geo.append(getGeo(facility))
+            addressStr = getAddressStr(facility)
+            response = geocode_cache_get(addressStr)
+            if response is not None:
+                logger.info(
+                    "Got cached coordinations for facility: " + facility.facility_name
+                )
+                # cached responses go into the snapshot too, so a replay needs no cache
+                if context.snapshot_run_dir is not None:
+                    snapshotContent(
+                        geocodeUrl(addressStr),
+                        200,
+                        {"Content-Type": "application/json"},
+                        json.dumps(response).encode("utf-8"),
+                    )
+                facilities_geo.append(applyGeo(facility, response))
+            else:
+                pending.setdefault(addressStr, []).append(facility)
+                facilities_geo.append(facility)
+
+        if len(pending) != 0:
+            logger.info(
+                "Geocoding " + str(len(pending)) + " new addresses concurrently..."
+            )
+            with cityThreadPool(GEOCODE_WORKERS) as executor:
+                futures = {
+                    executor.submit(geocoder, addressStr): addressStr
+                    for addressStr in pending
+                }
+                for future in as_completed(futures):
+                    addressStr = futures[future]
+                    response = future.result()
+                    for facility in pending[addressStr]:
+                        applyGeo(facility, response)
+                    geocode_cache_put(addressStr, response)
+
         return facilities_geo
     except Exception as e:
         logger.warning(e)
 
 
-def getGeo(facility):
+def getGeo(facility, geocoder=None):
     logger.info(
-        "Getting latitude and longitude for facility: " + facility["facility_name"]
+        "Getting latitude and longitude for facility: " + facility.facility_name
     )
+    if geocoder is None:
+        geocoder = requestGeocode
+    open_geocode_cache()
+    addressStr = getAddressStr(facility)
+    response = geocode_cache_get(addressStr)
+    if response is None:
+        response = geocoder(addressStr)
+        geocode_cache_put(addressStr, response)
+    return applyGeo(facility, response)
+
+
+def getAddressStr(facility):
     addressStr = (
-        facility["street"] + " " + facility["city"] + " " + facility["province"]
+        facility.street + " " + facility.city + " " + facility.province
     )
-    addressStr = addressStr.replace(" ", "%20")
-    url = GOOGLE_API_URL + addressStr + "&key=" + GOOGLE_API_KEY
+    return " ".join(addressStr.split())
+
+
+def requestGeocode(addressStr):
+    waitForGeocodeSlot()
     params = {"key": "value"}
-    r = requests.get(url=url, params=params)
-    response = r.json()
+    r = getSession().get(url=geocodeUrl(addressStr), params=params, timeout=HTTP_TIMEOUT)
+    return r.json()
+
+
+def geocodeUrl(addressStr):
+    return GOOGLE_API_URL + addressStr.replace(" ", "%20") + "&key=" + GOOGLE_API_KEY
+
+
+def waitForGeocodeSlot():
+    context = runContext()
+    with geocode_lock:
+        now = time.monotonic()
+        next_request = max(now, context.geocode_next_request)
+        wait = context.geocode_next_request - now
+        context.geocode_next_request = next_request + 1 / context.geocode_rate_limit
+    if wait > 0:
+        time.sleep(wait)
+
+
+def applyGeo(facility, response):
     geometry = response["results"][0]["geometry"]["location"]
-    facility["lat"] = geometry["lat"]
-    facility["lng"] = geometry["lng"]
-    if facility["postal_code"] == "":
-        facility["postal_code"] = response["results"][0]["address_components"][-1][
+    facility.lat = geometry["lat"]
+    facility.lng = geometry["lng"]
+    if facility.postal_code == "":
+        facility.postal_code = response["results"][0]["address_components"][-1][
             "short_name"
         ]
     return facility
 
 
+def open_geocode_cache():
+    context = runContext()
+    if context.geocode_cache is not None:
+        return
+    context.geocode_cache = sqlite3.connect(GEOCODE_CACHE_PATH, timeout=GEOCODE_CACHE_TIMEOUT)
+    context.geocode_cache.execute(GEOCODE_CACHE_WAL_SQL)
+    context.geocode_cache.execute(GEOCODE_CACHE_TABLE_SQL)
+    expired = context.geocode_cache.execute(
+        DELETE_EXPIRED_GEOCODES_SQL, (time.time() - GEOCODE_CACHE_TTL_DAYS * 86400,)
+    ).rowcount
+    context.geocode_cache.commit()
+    logger.info(
+        "Opened geocode cache "
+        + GEOCODE_CACHE_PATH
+        + ", removed "
+        + str(expired)
+        + " expired entries"
+    )
+
+
+def geocode_cache_key(addressStr):
+    return addressStr.casefold()
+
+
+def geocode_cache_get(addressStr):
+    context = runContext()
+    row = context.geocode_cache.execute(
+        FIND_GEOCODE_SQL, (geocode_cache_key(addressStr),)
+    ).fetchone()
+    if row is None or row[1] < time.time() - GEOCODE_CACHE_TTL_DAYS * 86400:
+        return None
+    return json.loads(row[0])
+
+
+def geocode_cache_put(addressStr, response):
+    # only successful lookups are cached, failures are retried next run
+    context = runContext()
+    if response.get("status") != "OK" or len(response.get("results", [])) == 0:
+        return
+    context.geocode_cache.execute(
+        SAVE_GEOCODE_SQL,
+        (geocode_cache_key(addressStr), json.dumps(response), time.time()),
+    )
+    context.geocode_cache.commit()
+
+
+def invalidate_geocode_cache(addressStr=None):
+    context = runContext()
+    open_geocode_cache()
+    if addressStr is None:
+        removed = context.geocode_cache.execute(DELETE_ALL_GEOCODES_SQL).rowcount
+    else:
+        removed = context.geocode_cache.execute(
+            DELETE_GEOCODE_SQL, (geocode_cache_key(addressStr),)
+        ).rowcount
+    context.geocode_cache.commit()
+    logger.info("Removed " + str(removed) + " entries from geocode cache")
+
+
 def getPhoneUrlToFacilities(facilities):
     
     logger.info("Start getting phone numbers and urls for facilities...")
@@ -300,91 +1601,351 @@ def getPhoneUrlToFacilities(facilities):
         #         {"Name": name, "phone": phone, "url": CITY_OF_TORONTO_URL + url}
         #     )
 
-        phoneList = []
-        with open("FacilitiyList.txt") as file:
-            for line in file:
-                line = line.strip()
-                dicts = line.split(', ')
-                phoneList.append({dicts[0].split(': ')[0].strip("{").strip("'") : dicts[0].split(': ')[1].strip("'").strip('"'), dicts[1].split(': ')[0].strip("'") : dicts[1].split(': ')[1].strip("'"), dicts[2].split(': ')[0].strip("'") : dicts[2].split(': ')[1].strip("}").strip("'")})
-
-        # if a facility is not on the list, get phone number from its website
+        loadFacilityDirectory()
+        missing = []
         for facility in facilities:
             logger.info(
                 "Getting phone number and urls for facility: "
-                + facility["facility_name"]
+                + facility.facility_name
             )
-            facility['phone'] = None
-            facility['url'] = None
-            for phone in phoneList:
-                if facility["facility_name"] == phone["Name"]:
-                    facility["phone"] = phone["phone"]
-                    facility["url"] = phone["url"]
-                    logger.info("Got phone number for" + facility["facility_name"])
-                    break
-
-            if facility["phone"] is None:
-                url = FACILITY_URL_PREFIX + str(facility["location_id"]) + "/index.html"
-                facility["url"] = url
-                r = requests.get(url=url)
-                html = r.text
-                soup = BeautifulSoup(html, "lxml")
-                li = (
-                    soup.find("div", attrs={"id": "pfr_complex_loc"})
-                    .find("ul")
-                    .find("li")
-                )
-                if "Phone" in li.text.strip():
-                    facility["phone"] = li.text.strip().split(":")[1].strip()
-                    logger.info("Got phone number for" + facility["facility_name"])
+            facility.phone = None
+            facility.url = None
+            phone = lookupFacilityDirectory(facility.facility_name)
+            if phone is not None:
+                facility.phone = phone["phone"]
+                facility.url = phone["url"]
+                logger.info("Got phone number for" + facility.facility_name)
+            else:
+                missing.append(facility)
+
+        # if a facility is not on the list, get phone number from its website
+        scrapeFacilityPhones(missing)
 
-        sorted(facilities, key=lambda x: x["location_id"])
+        sorted(facilities, key=lambda x: x.location_id)
         return facilities
     except Exception as e:
         logger.warning(e)
 
 
+def loadFacilityDirectory():
+    context = runContext()
+    mtime = None
+    if os.path.exists(context.facility_list_path):
+        mtime = os.path.getmtime(context.facility_list_path)
+    if context.facility_directory is not None and context.facility_directory_mtime == mtime:
+        return context.facility_directory
+
+    if os.path.exists(context.facility_directory_path) and (
+        mtime is None or os.path.getmtime(context.facility_directory_path) >= mtime
+    ):
+        with open(context.facility_directory_path) as fp:
+            entries = json.load(fp)
+    else:
+        entries = parseFacilityList()
+        with open(context.facility_directory_path, "w") as fp:
+            json.dump(entries, fp, indent=2)
+        logger.info("Saved facility directory to " + context.facility_directory_path)
+
+    context.facility_directory = {}
+    for entry in entries:
+        context.facility_directory.setdefault(normalizeFacilityName(entry["Name"]), entry)
+    # names without their punctuation and stop words, for the second lookup
+    context.facility_directory_words = {}
+    for key in context.facility_directory:
+        context.facility_directory_words.setdefault(facilityNameWords(key), []).append(key)
+    context.facility_directory_mtime = mtime
+    logger.info("Loaded " + str(len(context.facility_directory)) + " facilities from directory")
+    return context.facility_directory
+
+
+def parseFacilityList():
+    # each line of FacilitiyList.txt is a python dict with Name, phone and url
+    context = runContext()
+    entries = []
+    with open(context.facility_list_path) as file:
+        for line in file:
+            line = line.strip()
+            if line == "":
+                continue
+            try:
+                entry = ast.literal_eval(line)
+                entries.append(
+                    {"Name": entry["Name"], "phone": entry["phone"], "url": entry["url"]}
+                )
+            except (ValueError, SyntaxError, KeyError):
+                logger.warning("Could not parse facility list line: " + line)
+    return entries
+
+
+def normalizeFacilityName(name):
+    name = name.casefold().replace("&", " and ")
+    name = re.sub(r"[^\w\s]", " ", name)
+    return " ".join(name.split())
+
+
+def lookupFacilityDirectory(name):
+    # returns None unless exactly one directory entry matches, the facility
+    # page is scraped instead
+    context = runContext()
+    key = normalizeFacilityName(name)
+    entry = context.facility_directory.get(key)
+    if entry is None:
+        matches = context.facility_directory_words.get(facilityNameWords(key), [])
+        if len(matches) == 1:
+            entry = context.facility_directory[matches[0]]
+            logger.info("Matched facility " + name + " to " + entry["Name"])
+    if entry is None and FACILITY_FUZZY_MATCH:
+        matches = difflib.get_close_matches(
+            key, context.facility_directory.keys(), n=2, cutoff=FACILITY_MATCH_CUTOFF
+        )
+        if len(matches) == 1:
+            entry = context.facility_directory[matches[0]]
+            logger.warning("Fuzzy matched facility " + name + " to " + entry["Name"])
+    return entry
+
+
+def facilityNameWords(key):
+    return tuple(word for word in key.split() if word not in FACILITY_STOP_WORDS)
+
+
+def scrapeFacilityPhones(facilities):
+    if len(facilities) == 0:
+        return facilities
+    logger.info(
+        "Scraping " + str(len(facilities)) + " facility pages for phone numbers..."
+    )
+    with cityThreadPool(SCRAPE_WORKERS) as executor:
+        for facility, (url, phone) in zip(
+            facilities,
+            executor.map(
+                scrapeFacilityPhone, [facility.location_id for facility in facilities]
+            ),
+        ):
+            facility.url = url
+            if phone is not None:
+                facility.phone = phone
+                logger.info("Got phone number for" + facility.facility_name)
+    return facilities
+
+
+def scrapeFacilityPhone(location_id):
+    # returns (url, phone), phone is None when the page does not list one
+    context = runContext()
+    url = context.facility_url_prefix + str(location_id) + "/index.html"
+    try:
+        r = getSession().get(url=url, timeout=HTTP_TIMEOUT)
+        # only the location block of the page is parsed
+        soup = BeautifulSoup(
+            r.content,
+            "lxml",
+            parse_only=SoupStrainer("div", attrs={"id": "pfr_complex_loc"}),
+        )
+        li = soup.find("div", attrs={"id": "pfr_complex_loc"}).find("ul").find("li")
+        if "Phone" in li.text.strip():
+            return url, li.text.strip().split(":")[1].strip()
+    except Exception as e:
+        logger.warning("Could not scrape " + url + ": " + str(e))
+    return url, None
+
+
+def dimension_key(description):
+    # descriptions are compared case and accent insensitively, like the
+    # utf8mb4_0900_ai_ci collation
+    description = unicodedata.normalize("NFKD", description.casefold())
+    return "".join(c for c in description if not unicodedata.combining(c))
+
+
+def load_dimension_cache():
+    context = runContext()
+    logger.info("Loading dimension cache...")
+    context.category_cache = {}
+    context.type_cache = {}
+    context.activity_cache = {}
+    context.facility_cache = {}
+    context.cache_hits = 0
+    context.cache_misses = 0
+
+    with db_cursor() as cursor:
+        cursor.execute(LOAD_CATEGORIES_SQL)
+        for row in cursor.fetchall():
+            context.category_cache.setdefault(dimension_key(row[1]), row[0])
+        cursor.execute(LOAD_TYPES_SQL)
+        for row in cursor.fetchall():
+            context.type_cache.setdefault(dimension_key(row[1]), row[0])
+        cursor.execute(LOAD_ACTIVITIES_SQL)
+        for row in cursor.fetchall():
+            context.activity_cache[row[0]] = row[0]
+        cursor.execute(LOAD_FACILITIES_SQL)
+        for row in cursor.fetchall():
+            context.facility_cache.setdefault(row[0], row[1])
+
+    logger.info(
+        "Dimension cache loaded: "
+        + str(len(context.category_cache))
+        + " categories, "
+        + str(len(context.type_cache))
+        + " types, "
+        + str(len(context.activity_cache))
+        + " activities, "
+        + str(len(context.facility_cache))
+        + " facilities"
+    )
+    load_translation_cache()
+
+
+def load_translation_cache():
+    context = runContext()
+    context.translation_cache = {}
+    with db_cursor() as cursor:
+        cursor.execute(LOAD_TRANSLATIONS_SQL)
+        for row in cursor.fetchall():
+            context.translation_cache.setdefault((row[1], dimension_key(row[2])), row[0])
+    logger.info("Translation cache loaded: " + str(len(context.translation_cache)) + " strings")
+
+
+def intern_translation(description):
+    # returns the id of an existing translation of description, or of a new one
+    context = runContext()
+    key = (language_id, dimension_key(description))
+    if context.translation_cache is not None and key in context.translation_cache:
+        return context.translation_cache[key]
+
+    # insert a new row into Table Translation
+    translation_id = executeInsertSQL(TRANSLATION_SQL, None)
+    context.row_affected_traslation += 1
+    logger.info("Inserted a new Translation: " + str(translation_id))
+
+    # insert a new row into Table Language_Translation
+    language_translation_val = (translation_id, language_id, description)
+    executeInsertSQL(LANGUAGE_TRANSLATION_SQL, language_translation_val)
+    context.row_affected_language_traslation += 1
+    logger.info("Inserted a new Language_Translation: " + description)
+
+    cache_put(context.translation_cache, key, translation_id)
+    return translation_id
+
+
+def intern_translations(descriptions):
+    # inserts every description that has no translation yet in batches
+    context = runContext()
+    if context.translation_cache is None:
+        return
+    new_descriptions = {}
+    for description in descriptions:
+        key = (language_id, dimension_key(description))
+        if key not in context.translation_cache:
+            new_descriptions.setdefault(key, description)
+    new_descriptions = list(new_descriptions.items())
+
+    with db_cursor() as cursor:
+        for i in range(0, len(new_descriptions), TRANSLATION_BATCH_SIZE):
+            chunk = new_descriptions[i : i + TRANSLATION_BATCH_SIZE]
+            # ids of a multi-row insert are consecutive, starting at lastrowid
+            cursor.execute(TRANSLATION_BATCH_SQL + ", ".join(["()"] * len(chunk)))
+            first_id = cursor.lastrowid
+            context.row_affected_traslation += cursor.rowcount
+
+            values = []
+            for offset, (key, description) in enumerate(chunk):
+                values.extend((first_id + offset, language_id, description))
+            cursor.execute(
+                LANGUAGE_TRANSLATION_BATCH_SQL + ", ".join(["(%s, %s, %s)"] * len(chunk)),
+                values,
+            )
+            context.row_affected_language_traslation += cursor.rowcount
+            for offset, (key, description) in enumerate(chunk):
+                cache_put(context.translation_cache, key, first_id + offset)
+            logger.info("Inserted a batch of " + str(len(chunk)) + " Translations")
+
+
+def intern_availability_translations(availabilities):
+    # batches the titles of categories, types and activities that will be created
+    context = runContext()
+    if context.translation_cache is None or context.category_cache is None:
+        return
+    descriptions = []
+    for availability in availabilities:
+        if dimension_key(availability.category) not in context.category_cache:
+            descriptions.append(availability.category)
+        if dimension_key(availability.type) not in context.type_cache:
+            descriptions.append(availability.type)
+        if int(availability.course_id) not in context.activity_cache:
+            descriptions.append(availability.course_title)
+    run_unit(intern_translations, descriptions)
+
+
+def cache_put(cache, key, value):
+    # adds key to cache, journaled so rollback_units() can take it out again
+    context = runContext()
+    if cache is None or key in cache:
+        return
+    cache[key] = value
+    context.cache_journal.append((cache, key))
+
+
+def cache_lookup(cache, key):
+    context = runContext()
+    if key in cache:
+        context.cache_hits += 1
+        return cache[key]
+    context.cache_misses += 1
+    return 0
+
+
 def facility_exists(location_id: int):
+    context = runContext()
+    if context.facility_cache is not None:
+        return cache_lookup(context.facility_cache, int(location_id))
+
     facility_id = 0
-    cursor = mydb.cursor()
-    cursor.execute(FIND_FACILITY_BY_LOCATION_ID, (location_id,))
-    rows = cursor.fetchall()
-    if len(rows) != 0:
-        facility_id = rows[0][0]
-    cursor.close()
+    with db_cursor() as cursor:
+        cursor.execute(FIND_FACILITY_BY_LOCATION_ID, (location_id,))
+        rows = cursor.fetchall()
+        if len(rows) != 0:
+            facility_id = rows[0][0]
     
     return facility_id
 
 
 def activity_exists(activity: int):
+    context = runContext()
+    if context.activity_cache is not None:
+        return cache_lookup(context.activity_cache, int(activity))
+
     activity_id = 0
-    cursor = mydb.cursor()
-    cursor.execute(FIND_ACTIVITY_BY_ID, (activity,))
-    rows = cursor.fetchall()
-    if len(rows) != 0:
-        activity_id = rows[0][0]
-    cursor.close()
+    with db_cursor() as cursor:
+        cursor.execute(FIND_ACTIVITY_BY_ID, (activity,))
+        rows = cursor.fetchall()
+        if len(rows) != 0:
+            activity_id = rows[0][0]
     return activity_id
 
 
 def type_exists(type_des):
+    context = runContext()
+    if context.type_cache is not None:
+        return cache_lookup(context.type_cache, dimension_key(type_des))
+
     type_id = 0
-    cursor = mydb.cursor()
-    cursor.execute(FIND_TYPE_BY_DESC, (type_des,))
-    rows = cursor.fetchall()
-    if len(rows) != 0:
-        type_id = rows[0][0]
-    cursor.close()
+    with db_cursor() as cursor:
+        cursor.execute(FIND_TYPE_BY_DESC, (type_des,))
+        rows = cursor.fetchall()
+        if len(rows) != 0:
+            type_id = rows[0][0]
     return type_id
 
 
 def category_exists(category):
+    context = runContext()
+    if context.category_cache is not None:
+        return cache_lookup(context.category_cache, dimension_key(category))
+
     category_id = 0
-    cursor = mydb.cursor()
-    cursor.execute(FIND_CATEGORY_BY_DESC, (category,))
-    rows = cursor.fetchall()
-    if len(rows) != 0:
-        category_id = rows[0][0]
-    cursor.close()
+    with db_cursor() as cursor:
+        cursor.execute(FIND_CATEGORY_BY_DESC, (category,))
+        rows = cursor.fetchall()
+        if len(rows) != 0:
+            category_id = rows[0][0]
     return category_id
 
 
@@ -392,30 +1953,55 @@ def get_new_facilities(facilities):
     logger.info("Getting new facilities...")
     new_facilities = []
     for facility in facilities:
-        if facility_exists(int(facility["location_id"])) == 0:
+        if facility_exists(int(facility.location_id)) == 0:
             new_facilities.append(facility)
     return new_facilities
 
 
 def update_db(availabilities, facilities):
+    # returns True once everything is committed
+    context = runContext()
     try:
-        if mydb == None:
+        if context.mydb == None:
             connect_db()
+        begin_units()
 
         if len(facilities) != 0:
+            run_unit(
+                intern_translations,
+                [facility.street for facility in facilities]
+                + [facility.facility_name for facility in facilities],
+            )
             for facility in facilities:
-                insert_new_facility(facility)
-        mydb.commit()
-
-        store_new_availabilities(availabilities)
-
-        mydb.commit()
-        log_rows_affected()
+                run_unit(insert_new_facility, facility)
+        commit_units()
+
+        if context.sync_mode:
+            summary = sync_availabilities(withoutEnded(availabilities))
+            commit_units()
+            log_change_summary(summary)
+        else:
+            store_new_availabilities(availabilities)
+            commit_units()
+            log_rows_affected()
+        log_cache_stats()
+        if AVAILABILITY_VIEW:
+            # a streamed file was consumed above, the view reads it once more
+            refresh_availability_view(
+                withoutEnded(
+                    withRegisteredPrograms(iterAvalibilities())
+                    if context.stream_dropins
+                    else availabilities
+                ),
+                facilities,
+            )
 
-        mydb.close()
+        context.mydb.close()
         logger.info("Database disconnected")
+        return True
     except Exception as e:
         logger.warning(e)
+        return False
 
 
 def insert_data_to_empty_db(availablities, facilities):
@@ -429,13 +2015,6 @@ def insert_data_to_empty_db(availablities, facilities):
     # address_id = 0
     # facility_id = 0
 
-    # control varialbles for iterations
-    category = ""
-    type = ""
-    activity = ""
-    facility = ""
-    country = "Canada"
-
     # # row affected counting for insertions
     # row_affected_traslation = 0
     # row_affected_language_traslation = 0
@@ -448,133 +2027,593 @@ def insert_data_to_empty_db(availablities, facilities):
     # row_affected_activity_facility = 0
     # row_affected_reference_facility_locationorigin = 0
 
+    context = runContext()
+    if context.bulk_load:
+        return bulk_insert_data_to_empty_db(availablities, facilities)
+
     logger.info("Connecting to MySQL...")
     try:
-        mydb = connect_db()
+        connect_db()
+        load_dimension_cache()
+        context.seed_type_cache = {}
+        begin_units()
+        run_unit(
+            intern_translations,
+            [facility.street for facility in facilities]
+            + [facility.facility_name for facility in facilities],
+        )
+        intern_availability_translations(availablities)
 
         for facility in facilities:
-            facility_id = insert_new_facility(facility)
-            facility["facility_id"] = facility_id
+            run_unit(insert_new_facility, facility)
 
         for availablity in availablities:
-            # get current values
-            category_current = availablity["category"]
-            type_current = availablity["type"]
-            activity_current = availablity["course_title"]
-            facility_current = availablity["location_id"]
-            activity_id = availablity["course_id"]
-
-            
-            # for facility in facilities:
-            #     if facility['location_id'] == facility_current:
-            #         facility_id = facility['facility_id']
-            facility_id = facility_exists(facility_current)
-
-            # insertion of categories
-            if category_current != category:
-                category_id = insert_new_category(category_current)
-                category = category_current
-
-            # insertion of types
-            if type_current != type:
-                type_id = insert_new_type(type_current, category_id)
-                type = type_current
-
-            # insertion of activities
-            if activity_current != activity:
-                activity_id = insert_new_activity(
-                    activity_current, activity_id, type_id, facility_id
-                )
-                activity = activity_current
+            run_unit(seed_availability, availablity)
+        commit_units()
+        log_rows_affected()
+        log_cache_stats()
+        if AVAILABILITY_VIEW:
+            refresh_availability_view(availablities, facilities)
 
-            inser_new_availability(availablity, facility_id, activity_id)
-        mydb.commit()
+        context.mydb.close()
+        logger.info("Database disconnected")
+    except Exception as e:
+        logger.warning(e)
+
+
+def seed_availability(availablity):
+    # types are created per category, activities and facilities are looked up
+    # by their ids in the Drop-in data
+    context = runContext()
+    category_id = category_exists(availablity.category)
+    if category_id == 0:
+        category_id = insert_new_category(availablity.category)
+
+    type_key = (category_id, dimension_key(availablity.type))
+    type_id = context.seed_type_cache.get(type_key, 0)
+    if type_id == 0:
+        type_id = insert_new_type(availablity.type, category_id)
+        cache_put(context.seed_type_cache, type_key, type_id)
+
+    facility_id = facility_exists(availablity.location_id)
+    activity_id = activity_exists(availablity.course_id)
+    if activity_id == 0:
+        activity_id = insert_new_activity(
+            availablity.course_title, availablity.course_id, type_id, facility_id
+        )
+
+    insert_new_availability(availablity, facility_id, activity_id)
+
+
+def bulk_insert_data_to_empty_db(availablities, facilities):
+    context = runContext()
+    logger.info("Connecting to MySQL for bulk loading...")
+    try:
+        connect_db()
+        tables = build_bulk_rows(availablities, facilities)
+
+        with tempfile.TemporaryDirectory(prefix="active_bulk_") as staging_dir:
+            with db_cursor() as cursor:
+                cursor.execute("SET FOREIGN_KEY_CHECKS = 0;")
+                rows_loaded = {}
+                for table, columns in BULK_LOAD_TABLES:
+                    path = write_staging_file(staging_dir, table, tables[table])
+                    cursor.execute(
+                        LOAD_DATA_SQL.format(
+                            table, ", ".join("`" + column + "`" for column in columns)
+                        ),
+                        (path,),
+                    )
+                    rows_loaded[table] = cursor.rowcount
+                    logger.info(
+                        "Loaded " + str(cursor.rowcount) + " rows into " + table
+                    )
+                cursor.execute("SET FOREIGN_KEY_CHECKS = 1;")
+
+        violations = validate_foreign_keys()
+        if violations != 0:
+            context.mydb.rollback()
+            logger.warning(
+                "Bulk load rolled back: "
+                + str(violations)
+                + " foreign key violations"
+            )
+            context.mydb.close()
+            return
+
+        context.mydb.commit()
+        context.row_affected_traslation += rows_loaded["translation"]
+        context.row_affected_language_traslation += rows_loaded["language_translation"]
+        context.row_affected_address += rows_loaded["address"]
+        context.row_affected_facility += rows_loaded["facility"]
+        context.row_affected_reference_facility_locationorigin += rows_loaded[
+            "reference_facility_locationorigin"
+        ]
+        context.row_affected_categoty += rows_loaded["category"]
+        context.row_affected_type += rows_loaded["type"]
+        context.row_affected_activity += rows_loaded["activity"]
+        context.row_affected_activity_facility += rows_loaded["facility_activity"]
+        context.row_affected_availability += rows_loaded["availability"]
         log_rows_affected()
+        if AVAILABILITY_VIEW:
+            # ids of the loaded rows are read back from the database
+            load_dimension_cache()
+            refresh_availability_view(availablities, facilities)
 
-        mydb.close()
+        context.mydb.close()
         logger.info("Database disconnected")
     except Exception as e:
         logger.warning(e)
 
 
+def build_bulk_rows(availablities, facilities):
+    context = runContext()
+    logger.info("Building rows for bulk loading...")
+    tables = {table: [] for table, columns in BULK_LOAD_TABLES}
+    translation_id = next_table_id("translation")
+    address_id = next_table_id("address")
+    facility_id = next_table_id("facility")
+    category_id = next_table_id("category")
+    type_id = next_table_id("type")
+    availability_id = next_table_id("availability")
+
+    translation_ids = {}
+
+    def new_translation(description):
+        nonlocal translation_id
+        key = dimension_key(description)
+        if key in translation_ids:
+            return translation_ids[key]
+        translation_ids[key] = translation_id
+        tables["translation"].append((translation_id,))
+        tables["language_translation"].append(
+            (translation_id, language_id, description)
+        )
+        translation_id += 1
+        return translation_id - 1
+
+    facility_ids = {}
+    for facility in facilities:
+        street_translation_id = new_translation(facility.street)
+        tables["address"].append(
+            (
+                address_id,
+                street_translation_id,
+                facility.city,
+                facility.province,
+                facility.postal_code.replace(" ", ""),
+                context.country,
+                facility.lat,
+                facility.lng,
+            )
+        )
+        title_translation_id = new_translation(facility.facility_name)
+        tables["facility"].append(
+            (
+                facility_id,
+                facility.phone,
+                address_id,
+                title_translation_id,
+                facility.url,
+                context.city_id,
+            )
+        )
+        tables["reference_facility_locationorigin"].append(
+            (facility_id, facility.location_id)
+        )
+        facility.facility_id = facility_id
+        facility_ids[int(facility.location_id)] = facility_id
+        address_id += 1
+        facility_id += 1
+
+    category_ids = {}
+    type_ids = {}
+    activity_ids = set()
+    facility_activities = set()
+    skipped = 0
+    for availablity in availablities:
+        location_id = int(availablity.location_id)
+        if location_id not in facility_ids:
+            skipped += 1
+            continue
+
+        category_key = dimension_key(availablity.category)
+        if category_key not in category_ids:
+            category_ids[category_key] = category_id
+            tables["category"].append(
+                (category_id, context.city_id, new_translation(availablity.category))
+            )
+            category_id += 1
+
+        type_key = (category_ids[category_key], dimension_key(availablity.type))
+        if type_key not in type_ids:
+            type_ids[type_key] = type_id
+            tables["type"].append(
+                (type_id, type_key[0], new_translation(availablity.type))
+            )
+            type_id += 1
+
+        activity_id = int(availablity.course_id)
+        if activity_id not in activity_ids:
+            activity_ids.add(activity_id)
+            tables["activity"].append(
+                (
+                    activity_id,
+                    type_ids[type_key],
+                    new_translation(availablity.course_title),
+                )
+            )
+
+        facility_activity = (facility_ids[location_id], activity_id)
+        if facility_activity not in facility_activities:
+            facility_activities.add(facility_activity)
+            tables["facility_activity"].append(facility_activity)
+
+        tables["availability"].append(
+            (
+                availability_id,
+                facility_ids[location_id],
+                activity_id,
+                availablity.start_time.replace("T", " "),
+                availablity.end_time.replace("T", " "),
+                availablity.age_min,
+                availablity.age_max,
+            )
+        )
+        availability_id += 1
+
+    if skipped != 0:
+        logger.warning(
+            "Skipped " + str(skipped) + " availabilities without a known facility"
+        )
+    return tables
+
+
+def next_table_id(table):
+    with db_cursor() as cursor:
+        cursor.execute(AUTO_INCREMENT_SQL, (table,))
+        row = cursor.fetchone()
+        auto_increment = row[0] if row is not None and row[0] is not None else 1
+        cursor.execute(MAX_ID_SQL.format(table))
+        max_id = cursor.fetchone()[0]
+    return max(auto_increment, max_id + 1)
+
+
+def tsv_field(value):
+    if value is None:
+        return "\\N"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def write_staging_file(directory, table, rows):
+    path = os.path.join(directory, table + ".tsv")
+    with open(path, "w", encoding="utf-8", newline="\n") as fp:
+        for row in rows:
+            fp.write("\t".join(tsv_field(value) for value in row) + "\n")
+    return path
+
+
+def validate_foreign_keys():
+    violations = 0
+    with db_cursor() as cursor:
+        for foreign_key in BULK_FOREIGN_KEYS:
+            cursor.execute(FOREIGN_KEY_VIOLATIONS_SQL.format(*foreign_key))
+            count = cursor.fetchone()[0]
+            if count != 0:
+                logger.warning(
+                    "Found "
+                    + str(count)
+                    + " rows in "
+                    + foreign_key[0]
+                    + " with a missing "
+                    + foreign_key[2]
+                )
+            violations += count
+    return violations
+
+
 def store_new_availabilities(availabilities):
+    context = runContext()
+    if isinstance(availabilities, list):
+        intern_availability_translations(availabilities)
+    # a resumed update skips the availabilities committed before it failed,
+    # they are extracted in the same order with the same cutoff; the ones that
+    # ended since then still count for the position but are not stored
+    watermark = context.availability_position
+    now = datetime.now()
+    for position, availability in enumerate(availabilities):
+        if position < watermark:
+            continue
+        context.availability_position = position + 1
+        if hasEnded(availability, now):
+            continue
+        run_unit(store_new_availability, availability)
+
+
+def store_new_availability(availability):
+    facility_id, activity_id = resolve_availability_ids(availability)
+    insert_new_availability(availability, facility_id, activity_id)
+
+
+def resolve_availability_ids(availability):
+    # returns (facility_id, activity_id), creating missing categories, types and activities
+    category_id = category_exists(availability.category)
+    type_id = type_exists(availability.type)
+    activity_id = activity_exists(availability.course_id)
+    facility_id = facility_exists(availability.location_id)
+    if category_id == 0:
+        category_id = insert_new_category(availability.category)
+
+    if type_id == 0:
+        type_id = insert_new_type(availability.type, category_id)
+
+    if activity_id == 0:
+        activity_id = insert_new_activity(
+            availability.course_title,
+            availability.course_id,
+            type_id,
+            facility_id
+        )
+    return facility_id, activity_id
+
+
+def sync_availabilities(availabilities):
+    # applies only the difference between the incoming availabilities and the
+    # table, keyed on (facility, activity, start, end, min age, max age), and
+    # returns a summary
+    context = runContext()
+    logger.info("Synchronizing availabilities...")
+    pruned = run_unit(prune_availabilities, datetime.now())
+    existing = retry_units(load_availability_keys)
+
+    if isinstance(availabilities, list):
+        intern_availability_translations(availabilities)
+    seen = set()
+    unchanged = 0
+    duplicates = 0
     for availability in availabilities:
-        category_id = category_exists(availability["category"])
-        type_id = type_exists(availability["type"])
-        activity_id = activity_exists(availability["course_id"])
-        facility_id = facility_exists(availability["location_id"])
-        if category_id == 0:
-            category_id = insert_new_category(availability["category"])
-
-        if type_id == 0:
-            type_id = insert_new_type(availability["type"], category_id)
-
-        if activity_id == 0:
-            activity_id = insert_new_activity(
-                availability["course_title"],
-                availability["course_id"],
-                type_id,
-                facility_id
+        # facilities are already stored and activity ids come from the data,
+        # so the key does not depend on rows created below
+        key = availability_key(
+            availability,
+            facility_exists(availability.location_id),
+            availability.course_id,
+        )
+        if key in seen:
+            duplicates += 1
+            continue
+        seen.add(key)
+        if key in existing:
+            # keep one row per key, extra copies are deleted below
+            existing[key].pop(0)
+            unchanged += 1
+        else:
+            run_unit(store_new_availability, availability)
+    run_unit(flush_availabilities)
+
+    stale_ids = [availability_id for ids in existing.values() for availability_id in ids]
+    deleted = run_unit(delete_availabilities, stale_ids)
+
+    return {
+        "inserted": context.row_affected_availability,
+        "deleted": deleted,
+        "unchanged": unchanged,
+        "pruned": pruned,
+        "duplicates_skipped": duplicates,
+    }
+
+
+def prune_availabilities(now):
+    with db_cursor() as cursor:
+        cursor.execute(PRUNE_AVAILABILITIES_SQL, (now,))
+        pruned = cursor.rowcount
+    logger.info("Pruned " + str(pruned) + " past Availabilities")
+    return pruned
+
+
+def load_availability_keys():
+    existing = {}
+    with db_cursor() as cursor:
+        cursor.execute(LOAD_AVAILABILITY_KEYS_SQL)
+        for row in cursor.fetchall():
+            existing.setdefault(tuple(row[1:7]), []).append(row[0])
+    return existing
+
+
+def availability_key(availability, facility_id, activity_id):
+    return (
+        facility_id,
+        int(activity_id),
+        datetime.strptime(availability.start_time, "%Y-%m-%dT%H:%M:%S"),
+        datetime.strptime(availability.end_time, "%Y-%m-%dT%H:%M:%S"),
+        # a session whose ages changed is replaced, streamed ages may be strings
+        None if availability.age_min is None else int(availability.age_min),
+        None if availability.age_max is None else int(availability.age_max),
+    )
+
+
+def delete_availabilities(ids):
+    deleted = 0
+    with db_cursor() as cursor:
+        for i in range(0, len(ids), AVAILABILITY_BATCH_SIZE):
+            chunk = ids[i : i + AVAILABILITY_BATCH_SIZE]
+            cursor.execute(
+                DELETE_AVAILABILITIES_SQL.format(", ".join(["%s"] * len(chunk))), chunk
             )
+            deleted += cursor.rowcount
+            logger.info("Deleted a batch of " + str(cursor.rowcount) + " Availabilities")
+    return deleted
 
-        insert_new_availability(availability, facility_id, activity_id)
 
+def refresh_availability_view(availabilities, facilities):
+    # rebuilds availability_view from the rows of this run and swaps it in, so
+    # the app reads one indexed table instead of joining the normalized ones;
+    # returns True once the new view is in place
+    context = runContext()
+    logger.info("Refreshing availability_view...")
+    try:
+        view_facilities = {int(facility.location_id): facility for facility in facilities}
+        if any(location_id not in view_facilities for location_id in context.facility_cache):
+            # facilities stored by earlier runs
+            for facility in retry_units(load_view_facilities):
+                view_facilities.setdefault(int(facility.location_id), facility)
+
+        retry_units(create_view_staging)
+        begin_units()
+        rows = 0
+        skipped = 0
+        seen = set()
+        batch = []
+        for availability in availabilities:
+            facility_id = context.facility_cache.get(int(availability.location_id), 0)
+            category_id = context.category_cache.get(dimension_key(availability.category), 0)
+            facility = view_facilities.get(int(availability.location_id))
+            if facility_id == 0 or category_id == 0 or facility is None:
+                skipped += 1
+                continue
+            # one row per availability key, like sync_availabilities()
+            key = availability_key(availability, facility_id, availability.course_id)
+            if key in seen:
+                continue
+            seen.add(key)
+            batch.append(
+                (
+                    language_id,
+                    facility_id,
+                    int(availability.location_id),
+                    facility.facility_name,
+                    facility.street,
+                    facility.city,
+                    facility.postal_code.replace(" ", ""),
+                    facility.phone,
+                    facility.url,
+                    facility.lat,
+                    facility.lng,
+                    category_id,
+                    availability.category,
+                    availability.type,
+                    int(availability.course_id),
+                    availability.course_title,
+                    key[2],
+                    key[3],
+                    availability.age_min,
+                    availability.age_max,
+                )
+            )
+            if len(batch) >= AVAILABILITY_BATCH_SIZE:
+                run_unit(insert_view_rows, batch)
+                rows += len(batch)
+                batch = []
+        if len(batch) != 0:
+            run_unit(insert_view_rows, batch)
+            rows += len(batch)
+        commit_units()
+
+        retry_units(swap_availability_view)
+        if skipped != 0:
+            logger.warning(
+                "Left "
+                + str(skipped)
+                + " availabilities without a stored facility or category out of availability_view"
+            )
+        logger.info("Refreshed availability_view with " + str(rows) + " rows")
+        return True
+    except Exception as e:
+        logger.warning(e)
+        return False
+
+
+def load_view_facilities():
+    context = runContext()
+    facilities = []
+    with db_cursor() as cursor:
+        cursor.execute(LOAD_VIEW_FACILITIES_SQL, (language_id, language_id))
+        for row in cursor.fetchall():
+            facilities.append(
+                Facility(
+                    location_id=row[0],
+                    facility_name=row[2],
+                    city=row[4],
+                    street=row[3],
+                    province=context.province,
+                    postal_code=row[5],
+                    phone=row[6],
+                    url=row[7],
+                    lat=row[8],
+                    lng=row[9],
+                    facility_id=row[1],
+                )
+            )
+    return facilities
 
-def executeInsertSQL(sql: str, val):
-    cursor = mydb.cursor()
-    if val is None:
-        cursor.execute(sql)
-    else:
-        cursor.execute(sql, val)
-    return cursor.lastrowid
 
+def create_view_staging():
+    with db_cursor() as cursor:
+        cursor.execute(DROP_TABLE_SQL.format("availability_view_new"))
+        cursor.execute(AVAILABILITY_VIEW_TABLE_SQL.format("availability_view_new"))
 
-def insert_new_facility(facility):
-    facility_name = facility["facility_name"]
-    street = facility["street"]
-    city = facility["city"]
-    province = facility["province"]
-    postal_code = facility["postal_code"].replace(" ", "")
-    lat = facility["lat"]
-    lng = facility["lng"]
-    phone = facility["phone"]
-    url = facility["url"]
-    location_id = facility["location_id"]
-    global city_id, country, language_id
-    global row_affected_traslation, row_affected_language_traslation, row_affected_address, row_affected_traslation, row_affected_facility, row_affected_language_traslation, row_affected_reference_facility_locationorigin
 
-    # insert a new row into Table Translation
-    translation_id = executeInsertSQL(TRANSLATION_SQL, None)
-    row_affected_traslation += 1
-    logger.info("Inserted a new Translation: " + str(translation_id))
+def insert_view_rows(rows):
+    with db_cursor() as cursor:
+        sql = AVAILABILITY_VIEW_BATCH_SQL + ", ".join([AVAILABILITY_VIEW_VALUES_SQL] * len(rows))
+        cursor.execute(sql, [value for row in rows for value in row])
 
-    # insert a new row into Table Language_Translation
-    language_translation_val = (translation_id, language_id, street)
-    executeInsertSQL(LANGUAGE_TRANSLATION_SQL, language_translation_val)
-    row_affected_language_traslation += 1
-    logger.info("Inserted a new Language_Translation: " + street)
+
+def swap_availability_view():
+    with db_cursor() as cursor:
+        # the first refresh swaps with an empty view
+        cursor.execute(AVAILABILITY_VIEW_TABLE_SQL.format("availability_view"))
+        cursor.execute(DROP_TABLE_SQL.format("availability_view_old"))
+        # readers see either the previous view or the new one
+        cursor.execute(SWAP_AVAILABILITY_VIEW_SQL)
+        cursor.execute(DROP_TABLE_SQL.format("availability_view_old"))
+
+
+def executeInsertSQL(sql: str, val):
+    with db_cursor() as cursor:
+        if val is None:
+            cursor.execute(sql)
+        else:
+            cursor.execute(sql, val)
+        lastrowid = cursor.lastrowid
+    return lastrowid
+
+
+def insert_new_facility(facility):
+    context = runContext()
+    facility_name = facility.facility_name
+    street = facility.street
+    city = facility.city
+    province = facility.province
+    postal_code = facility.postal_code.replace(" ", "")
+    lat = facility.lat
+    lng = facility.lng
+    phone = facility.phone
+    url = facility.url
+    location_id = facility.location_id
+
+    # get the translation of the street
+    translation_id = intern_translation(street)
 
     # insert a new row into Table Address
-    address_val = (translation_id, city, province, postal_code, country, lat, lng)
+    address_val = (translation_id, city, province, postal_code, context.country, lat, lng)
     address_id = executeInsertSQL(ADDRESS_SQL, address_val)
-    row_affected_address += 1
+    context.row_affected_address += 1
     logger.info("Inserted a new Address: " + str(address_id))
 
-    # insert a new row into Table Translation
-    translation_id = executeInsertSQL(TRANSLATION_SQL, None)
-    row_affected_traslation += 1
-    logger.info("Inserted a new Translation: " + str(translation_id))
-
-    # insert a new row into Table Language_Translation
-    language_translation_val = (translation_id, language_id, facility_name)
-    executeInsertSQL(LANGUAGE_TRANSLATION_SQL, language_translation_val)
-    row_affected_language_traslation += 1
-    logger.info("Inserted a new Language_Translation: " + facility_name)
+    # get the translation of the facility name
+    translation_id = intern_translation(facility_name)
 
     # insert a new row into Table Facility
-    facility_val = (phone, address_id, translation_id, url, city_id)
+    facility_val = (phone, address_id, translation_id, url, context.city_id)
     facility_id = executeInsertSQL(FACILITY_SQL, facility_val)
-    row_affected_facility += 1
+    context.row_affected_facility += 1
     logger.info("Inserted a new Facility: " + str(facility_id))
 
     # insert a new row into Table Reference_Facility_Locationorigin
@@ -582,83 +2621,65 @@ def insert_new_facility(facility):
     executeInsertSQL(
         REFERENCE_FACILITY_LOCATIONORIGIN_SQL, reference_facility_locationorigin_val
     )
-    row_affected_reference_facility_locationorigin += 1
+    context.row_affected_reference_facility_locationorigin += 1
     logger.info("Insert a new Reference_Facility_Locationorigin: " + str(facility_id))
+    cache_put(context.facility_cache, int(location_id), facility_id)
+    # set here, so a replay after a rollback updates it with the new id
+    facility.facility_id = facility_id
 
     return facility_id
 
 
 def insert_new_category(new_category):
-    global city_id, row_affected_traslation, row_affected_language_traslation, row_affected_categoty
-    # insert a new row into Table Translation
-    translation_id = executeInsertSQL(TRANSLATION_SQL, None)
-    row_affected_traslation += 1
-    logger.info("Inserted a new Translation: " + str(translation_id))
-
-    # insert a new row into Table Languge_Translation
-    language_translation_val = (translation_id, language_id, new_category)
-    executeInsertSQL(LANGUAGE_TRANSLATION_SQL, language_translation_val)
-    row_affected_language_traslation += 1
-    logger.info("Inserted a new Language_Translation: " + new_category)
+    context = runContext()
+    # get the translation of the category title
+    translation_id = intern_translation(new_category)
 
     # insert a new row into Table Category
-    category_val = (city_id, translation_id)
+    category_val = (context.city_id, translation_id)
     category_id = executeInsertSQL(CATEGORY_SQL, category_val)
-    row_affected_categoty += 1
+    context.row_affected_categoty += 1
     logger.info(
         "Inserted a new Category: " + str(category_id) + "(" + new_category + ")"
     )
+    cache_put(context.category_cache, dimension_key(new_category), category_id)
 
     return category_id
 
 
 def insert_new_type(new_type, category_id):
-    global row_affected_traslation, row_affected_language_traslation, row_affected_type
-    # insert a new row into Table Translation
-    translation_id = executeInsertSQL(TRANSLATION_SQL, None)
-    row_affected_traslation += 1
-    logger.info("Inserted a new Translation: " + str(translation_id))
-
-    # insert a new row into Table Languge_Translation
-    language_translation_val = (translation_id, language_id, new_type)
-    executeInsertSQL(LANGUAGE_TRANSLATION_SQL, language_translation_val)
-    row_affected_language_traslation += 1
-    logger.info("Inserted a new Language_Translation: " + new_type)
+    context = runContext()
+    # get the translation of the type title
+    translation_id = intern_translation(new_type)
 
     # insert a new row into Table Type
     type_val = (category_id, translation_id)
     type_id = executeInsertSQL(TYPE_SQL, type_val)
-    row_affected_type += 1
+    context.row_affected_type += 1
     logger.info("Inserted a new Type: " + str(type_id) + "(" + new_type + ")")
+    cache_put(context.type_cache, dimension_key(new_type), type_id)
 
     return type_id
 
 
 def insert_new_activity(new_activity, activity_id, type_id, facility_id):
-    global row_affected_traslation, row_affected_language_traslation, row_affected_activity, row_affected_activity_facility
-    # insert a new row into Table Translation
-    translation_id = executeInsertSQL(TRANSLATION_SQL, None)
-    row_affected_traslation += 1
-    logger.info("Inserted a new Translation: " + str(translation_id))
-
-    # insert a new row into Table Languge_Translation
-    language_translation_val = (translation_id, language_id, new_activity)
-    executeInsertSQL(LANGUAGE_TRANSLATION_SQL, language_translation_val)
-    row_affected_language_traslation += 1
-    logger.info("Inserted a new Language_Translation: " + new_activity)
+    context = runContext()
+    # get the translation of the activity title
+    translation_id = intern_translation(new_activity)
 
     # insert a new row into Table Activity
     activity_val = (activity_id, type_id, translation_id)
     executeInsertSQL(ACTIVITY_SQL, activity_val)
-    row_affected_activity += 1
+    context.row_affected_activity += 1
     logger.info(
         "Inserted a new Activity: " + str(activity_id) + "(" + new_activity + ")"
     )
+    cache_put(context.activity_cache, int(activity_id), activity_id)
 
     # insert a new row into Table Activity_Facility
     activity_facility_val = (facility_id, activity_id)
     executeInsertSQL(ACTIVITY_FACILITY_SQL, activity_facility_val)
-    row_affected_activity_facility += 1
+    context.row_affected_activity_facility += 1
     logger.info(
         "Inserted a new Activity_Facility: " + str(facility_id) + "-" + str(activity_id)
     )
@@ -667,13 +2688,13 @@ def insert_new_activity(new_activity, activity_id, type_id, facility_id):
 
 
 def insert_new_availability(availablity, facility_id, activity_id):
-    start_time = availablity["start_time"]
-    end_time = availablity["end_time"]
-    age_min = availablity["age_min"]
-    age_max = availablity["age_max"]
-    global row_affected_availability
+    context = runContext()
+    start_time = availablity.start_time
+    end_time = availablity.end_time
+    age_min = availablity.age_min
+    age_max = availablity.age_max
 
-    # insert a new row into Table Availability
+    # buffer a new row for Table Availability, written by flush_availabilities()
     availability_val = (
         facility_id,
         activity_id,
@@ -682,19 +2703,27 @@ def insert_new_availability(availablity, facility_id, activity_id):
         age_min,
         age_max,
     )
-    availability_id = executeInsertSQL(AVAILABILITY_SQL, availability_val)
-    row_affected_availability += 1
-    logger.info(
-        "Inserted a new Availability: "
-        + str(availability_id)
-        + "("
-        + start_time
-        + "-"
-        + end_time
-        + ")"
-    )
+    context.availability_buffer.append(availability_val)
+    if len(context.availability_buffer) >= AVAILABILITY_BATCH_SIZE:
+        flush_availabilities()
 
-    return availability_id
+
+def flush_availabilities():
+    context = runContext()
+    if len(context.availability_buffer) == 0:
+        return
+
+    with db_cursor() as cursor:
+        for i in range(0, len(context.availability_buffer), AVAILABILITY_BATCH_SIZE):
+            chunk = context.availability_buffer[i : i + AVAILABILITY_BATCH_SIZE]
+            sql = AVAILABILITY_BATCH_SQL + ", ".join([AVAILABILITY_VALUES_SQL] * len(chunk))
+            cursor.execute(sql, [value for row in chunk for value in row])
+            context.row_affected_availability += cursor.rowcount
+            logger.info("Inserted a batch of " + str(cursor.rowcount) + " Availabilities")
+    context.availability_buffer.clear()
+    if AVAILABILITY_COMMIT_PER_BATCH:
+        # committed by run_unit() once the current unit is complete
+        context.commit_requested = True
 
 
 def writeListToTxt(filename, mode, list):
@@ -704,18 +2733,226 @@ def writeListToTxt(filename, mode, list):
 
 
 def connect_db():
-    global mydb
+    context = runContext()
     try:
-        mydb = MySQL.connect(
-            host=HOST, user=DBUSER, password=PASSWORD, database=DATABASE
-        )
+        if context.db_pool is None:
+            context.db_pool = MySQL.pooling.MySQLConnectionPool(
+                pool_name="active_toronto",
+                pool_size=DB_POOL_SIZE,
+                host=HOST,
+                port=PORT,
+                user=DBUSER,
+                password=PASSWORD,
+                database=context.database,
+                allow_local_infile=True,
+            )
+        release_db()
+        context.mydb = context.db_pool.get_connection()
         logger.info("Connected to MySQL")
+        if not context.schema_migrated:
+            apply_migrations()
     except Exception as e:
         logger.warning(e)
 
 
+def release_db():
+    # returns the current connection to the pool, it may already be closed or broken
+    context = runContext()
+    try:
+        if context.mydb is not None:
+            context.mydb.close()
+    except Exception:
+        pass
+
+
+@contextmanager
+def db_cursor(*args, **kwargs):
+    context = runContext()
+    cursor = context.mydb.cursor(*args, **kwargs)
+    execute = cursor.execute
+
+    def counted_execute(*args, **kwargs):
+        with stats_lock:
+            context.db_statements += 1
+        return execute(*args, **kwargs)
+
+    cursor.execute = counted_execute
+    try:
+        yield cursor
+    finally:
+        cursor.close()
+
+
+def is_transient_error(e):
+    return getattr(e, "errno", None) in TRANSIENT_DB_ERRORS or isinstance(
+        e, MySQL.errors.OperationalError
+    )
+
+
+def begin_units():
+    context = runContext()
+    context.pending_units.clear()
+    context.cache_journal.clear()
+    context.availability_buffer.clear()
+    context.committed_rows_affected = snapshot_rows_affected()
+    context.commit_requested = False
+
+
+def run_unit(function, *args):
+    # runs one self-contained unit of writes and commits every COMMIT_EVERY units
+    context = runContext()
+    result = retry_units(function, *args)
+    context.pending_units.append((function, args))
+    if len(context.pending_units) >= COMMIT_EVERY or context.commit_requested:
+        commit_units()
+    return result
+
+
+def commit_units():
+    context = runContext()
+    retry_units(flush_and_commit)
+    logger.info("Committed " + str(len(context.pending_units)) + " units")
+    position = context.availability_position
+    if context.checkpoint is not None and context.checkpoint["availabilities"] != position:
+        context.checkpoint["availabilities"] = position
+        writeCheckpoint()
+    context.pending_units.clear()
+    context.cache_journal.clear()
+    context.committed_rows_affected = snapshot_rows_affected()
+    context.commit_requested = False
+
+
+def flush_and_commit():
+    context = runContext()
+    flush_availabilities()
+    context.mydb.commit()
+
+
+def retry_units(function, *args):
+    # on a transient error, reconnects and replays the uncommitted units before
+    # trying function again
+    context = runContext()
+    attempt = 0
+    while True:
+        try:
+            if attempt != 0:
+                reconnect_db()
+                for unit, unit_args in context.pending_units:
+                    unit(*unit_args)
+            return function(*args)
+        except Exception as e:
+            if attempt >= DB_RETRIES or not is_transient_error(e):
+                raise
+            attempt += 1
+            logger.warning(
+                "Transient database error, replaying "
+                + str(len(context.pending_units))
+                + " units (attempt "
+                + str(attempt)
+                + "): "
+                + str(e)
+            )
+            rollback_units()
+            time.sleep(DB_RETRY_DELAY * 2 ** (attempt - 1))
+
+
+def rollback_units():
+    context = runContext()
+    try:
+        context.mydb.rollback()
+    except Exception:
+        pass
+    # ids handed out since the last commit are gone
+    while len(context.cache_journal) != 0:
+        cache, key = context.cache_journal.pop()
+        cache.pop(key, None)
+    context.availability_buffer.clear()
+    restore_rows_affected(context.committed_rows_affected)
+    context.commit_requested = False
+
+
+def reconnect_db():
+    context = runContext()
+    release_db()
+    # the pool reconnects connections that were dropped
+    context.mydb = context.db_pool.get_connection()
+    logger.info("Reconnected to MySQL")
+
+
+def apply_migrations():
+    context = runContext()
+    with db_cursor() as cursor:
+        cursor.execute(SCHEMA_MIGRATIONS_TABLE_SQL)
+        cursor.execute(LOAD_SCHEMA_MIGRATIONS_SQL)
+        applied = set(row[0] for row in cursor.fetchall())
+        for version, description, indexes in SCHEMA_MIGRATIONS:
+            if version in applied:
+                continue
+            logger.info("Applying schema migration " + str(version) + ": " + description)
+            for table, index, columns in indexes:
+                # fresh schemas from active_v2_ddl.sql already have some of these
+                cursor.execute(INDEX_EXISTS_SQL, (table, index))
+                if cursor.fetchone()[0] != 0:
+                    continue
+                cursor.execute(
+                    CREATE_INDEX_SQL.format(
+                        index, table, ", ".join("`" + column + "`" for column in columns)
+                    )
+                )
+                logger.info("Created index " + index + " on " + table)
+            cursor.execute(SCHEMA_MIGRATION_SQL, (version, description))
+            context.mydb.commit()
+    context.schema_migrated = True
+
+
+def check_query_plans():
+    # returns False if any lookup query falls back to a full table scan
+    now = datetime.now()
+    queries = [
+        ("FIND_FACILITY_BY_LOCATION_ID", FIND_FACILITY_BY_LOCATION_ID, (0,)),
+        ("FIND_ACTIVITY_BY_ID", FIND_ACTIVITY_BY_ID, (0,)),
+        ("FIND_TYPE_BY_DESC", FIND_TYPE_BY_DESC, ("",)),
+        ("FIND_CATEGORY_BY_DESC", FIND_CATEGORY_BY_DESC, ("",)),
+        ("PRUNE_AVAILABILITIES_SQL", PRUNE_AVAILABILITIES_SQL, (now,)),
+        (
+            "FIND_AVAILABILITIES_BY_FACILITY_SQL",
+            FIND_AVAILABILITIES_BY_FACILITY_SQL,
+            (0, now, now),
+        ),
+        ("FIND_VIEW_BY_FACILITY_SQL", FIND_VIEW_BY_FACILITY_SQL, (0, now, now)),
+    ]
+    passed = True
+    with db_cursor(dictionary=True) as cursor:
+        # the view is created by the first refresh, before that an empty one is checked
+        cursor.execute(AVAILABILITY_VIEW_TABLE_SQL.format("availability_view"))
+        for name, sql, val in queries:
+            cursor.execute("EXPLAIN " + sql, val)
+            for row in cursor.fetchall():
+                rows = row.get("rows") or 0
+                if row.get("type") == "ALL" and rows >= EXPLAIN_SCAN_ROW_LIMIT:
+                    logger.warning(
+                        name
+                        + " scans all "
+                        + str(rows)
+                        + " rows of "
+                        + str(row.get("table"))
+                    )
+                    passed = False
+                else:
+                    logger.info(
+                        name
+                        + " reads "
+                        + str(row.get("table"))
+                        + " by "
+                        + str(row.get("type"))
+                        + " using "
+                        + str(row.get("key"))
+                    )
+    return passed
+
+
 def setuplogger():
-    global logger
+    global log_level, seed_mode, bulk_load, invalidate_geocodes, force_update, stream_dropins, availability_engine, sync_mode, check_plans, profile_dir, ingest_registered_programs, replay_snapshot, export_dir, load_db, run_cities, city_workers
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "-log",
@@ -723,101 +2960,733 @@ def setuplogger():
         default="debug",
         help="Provide logging level. Example --loglevel debug, default=debug",
     )
+    parser.add_argument(
+        "--seed",
+        action="store_true",
+        help="Populate an empty database once instead of running the weekly update",
+    )
+    parser.add_argument(
+        "--bulk-load",
+        action="store_true",
+        help="Seed the database with LOAD DATA LOCAL INFILE instead of row by row inserts",
+    )
+    parser.add_argument(
+        "--invalidate-geocode-cache",
+        action="store_true",
+        help="Clear the on-disk geocode cache before running",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Download and process every resource even if it has not changed",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stream Drop-in.json from disk instead of loading it into memory",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["loop", "pandas"],
+        default="loop",
+        help="Engine used to extract availabilities from Drop-in.json, default=loop",
+    )
+    parser.add_argument(
+        "--registered-programs",
+        action="store_true",
+        help="Also ingest Registered Programs.json, which is not downloaded otherwise",
+    )
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        help="Apply only inserted and removed availabilities and prune past ones",
+    )
+    parser.add_argument(
+        "--export",
+        default=None,
+        metavar="DIR",
+        help="Export availabilities and facilities as parquet into this directory",
+    )
+    parser.add_argument(
+        "--no-db",
+        action="store_true",
+        help="Do not write to the database, only export",
+    )
+    parser.add_argument(
+        "--cities",
+        default=None,
+        help="Run these cities, separated by commas, concurrently in worker processes",
+    )
+    parser.add_argument(
+        "--city-workers",
+        type=int,
+        default=0,
+        help="Run at most this many cities at a time, default=0 (one process per city)",
+    )
+    parser.add_argument(
+        "--replay",
+        default=None,
+        metavar="SNAPSHOT",
+        help="Run once from a recorded snapshot (a run directory or its name under SNAPSHOT_DIR) without network access",
+    )
+    parser.add_argument(
+        "--check-plans",
+        action="store_true",
+        help="EXPLAIN the lookup queries and exit with an error if any does a full scan",
+    )
+    parser.add_argument(
+        "--profile-dir",
+        default=None,
+        help="Write a cProfile dump of every pipeline stage into this directory",
+    )
     args = parser.parse_args()
+    profile_dir = args.profile_dir
+    check_plans = args.check_plans
+    sync_mode = args.sync
+    availability_engine = args.engine
+    ingest_registered_programs = args.registered_programs
+    replay_snapshot = args.replay
+    export_dir = args.export
+    load_db = not args.no_db
+    if args.cities is not None:
+        run_cities = [city.strip() for city in args.cities.split(",") if city.strip()]
+    city_workers = args.city_workers
+    force_update = args.force
+    stream_dropins = args.stream
+    seed_mode = args.seed
+    bulk_load = args.bulk_load
+    invalidate_geocodes = args.invalidate_geocode_cache
+    log_level = args.loglevel
+    setupHandlers(log_level)
+    logger.info("Loggers setup")
+
+
+def setupHandlers(level):
+    global logger
     logger = logging.getLogger()
-    logger.setLevel(args.loglevel.upper())
+    logger.setLevel(level.upper())
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
 
     formatter = logging.Formatter(
-        "%(asctime)s | %(levelname)s | %(message)s", "%Y-%m-%d %H:%M:%S"
+        "%(asctime)s | %(levelname)s | %(city)s%(message)s", "%Y-%m-%d %H:%M:%S"
     )
 
     stream_handler = logging.StreamHandler()
     stream_handler.setFormatter(formatter)
+    stream_handler.addFilter(cityLogPrefix)
     logger.addHandler(stream_handler)
 
     file_handler = logging.FileHandler("logs.log")
     file_handler.setFormatter(formatter)
+    file_handler.addFilter(cityLogPrefix)
     logger.addHandler(file_handler)
 
-    logger.info("Loggers setup")
+
+def cityLogPrefix(record):
+    # lines logged by the threads of a city run name the city
+    context = getattr(run_local, "context", None)
+    if context is None or context is default_context:
+        record.city = ""
+    else:
+        record.city = context.city + " | "
+    return True
 
 
 def log_rows_affected():
-    global row_affected_traslation, row_affected_language_traslation, row_affected_address, row_affected_facility, row_affected_categoty, row_affected_type, row_affected_activity, row_affected_activity_facility, row_affected_availability
-    logger.info("Inserted into Translation " + str(row_affected_traslation) + " rows")
+    context = runContext()
+    logger.info("Inserted into Translation " + str(context.row_affected_traslation) + " rows")
     logger.info(
         "Inserted into Language_Translation "
-        + str(row_affected_language_traslation)
+        + str(context.row_affected_language_traslation)
         + " rows"
     )
-    logger.info("Inserted into Address " + str(row_affected_address) + " rows")
-    logger.info("Inserted into Facility " + str(row_affected_facility) + " rows")
-    logger.info("Inserted into Category " + str(row_affected_categoty) + " rows")
-    logger.info("Inserted into Type " + str(row_affected_type) + " rows")
-    logger.info("Inserted into Activity " + str(row_affected_activity) + " rows")
+    logger.info("Inserted into Address " + str(context.row_affected_address) + " rows")
+    logger.info("Inserted into Facility " + str(context.row_affected_facility) + " rows")
+    logger.info("Inserted into Category " + str(context.row_affected_categoty) + " rows")
+    logger.info("Inserted into Type " + str(context.row_affected_type) + " rows")
+    logger.info("Inserted into Activity " + str(context.row_affected_activity) + " rows")
     logger.info(
         "Inserted into Activity_Facility "
-        + str(row_affected_activity_facility)
+        + str(context.row_affected_activity_facility)
         + " rows"
     )
     logger.info(
-        "Inserted into Availability " + str(row_affected_availability) + " rows"
-    )
-
-    row_affected_traslation = 0
-    row_affected_language_traslation = 0
-    row_affected_address = 0
-    row_affected_facility = 0
-    row_affected_categoty = 0
-    row_affected_type = 0
-    row_affected_activity = 0
-    row_affected_activity_facility = 0
-    row_affected_availability = 0
-
-
-# def run():
-#     setuplogger()
-#     logger.info('Start running Active-Toronto Scraper...')
-#     try:
-#         getResources()
-#         availabilities = getAvalibilities()
-#         facilities = getOriginalFacilities(availabilities)
-#         connect_db()
-#         facilities = get_new_facilities(facilities)
-#         facilities = getGeoToFacilities(facilities)
-#         facilities = getPhoneUrlToFacilities(facilities)
-#         # writeListToTxt("facilities", "w", facilities)
-#         insert_data_to_empty_db(availabilities, facilities)
-#         logger.info('------------------------------------------------End------------------------------------------------')
-#     except Exception as e:
-#         logger.warning(e)
+        "Inserted into Availability " + str(context.row_affected_availability) + " rows"
+    )
+    reset_rows_affected()
 
 
-def update():
-    setuplogger()
-    logger.info("Start weekly updating...")
+def log_change_summary(summary):
+    context = runContext()
+    logger.info(
+        "Availabilities: "
+        + str(summary["inserted"])
+        + " inserted, "
+        + str(summary["deleted"])
+        + " deleted, "
+        + str(summary["unchanged"])
+        + " unchanged, "
+        + str(summary["pruned"])
+        + " past rows pruned, "
+        + str(summary["duplicates_skipped"])
+        + " duplicates skipped"
+    )
+    logger.info(
+        "New dimensions: "
+        + str(context.row_affected_facility)
+        + " facilities, "
+        + str(context.row_affected_categoty)
+        + " categories, "
+        + str(context.row_affected_type)
+        + " types, "
+        + str(context.row_affected_activity)
+        + " activities"
+    )
+    reset_rows_affected()
+
+
+def reset_rows_affected():
+    context = runContext()
+    context.row_affected_traslation = 0
+    context.row_affected_language_traslation = 0
+    context.row_affected_address = 0
+    context.row_affected_facility = 0
+    context.row_affected_categoty = 0
+    context.row_affected_type = 0
+    context.row_affected_activity = 0
+    context.row_affected_activity_facility = 0
+    context.row_affected_availability = 0
+
+
+def snapshot_rows_affected():
+    context = runContext()
+    return (
+        context.row_affected_traslation,
+        context.row_affected_language_traslation,
+        context.row_affected_address,
+        context.row_affected_facility,
+        context.row_affected_categoty,
+        context.row_affected_type,
+        context.row_affected_activity,
+        context.row_affected_activity_facility,
+        context.row_affected_availability,
+        context.row_affected_reference_facility_locationorigin,
+    )
+
+
+def restore_rows_affected(snapshot):
+    context = runContext()
+    (
+        context.row_affected_traslation,
+        context.row_affected_language_traslation,
+        context.row_affected_address,
+        context.row_affected_facility,
+        context.row_affected_categoty,
+        context.row_affected_type,
+        context.row_affected_activity,
+        context.row_affected_activity_facility,
+        context.row_affected_availability,
+        context.row_affected_reference_facility_locationorigin,
+    ) = snapshot
+
+
+def log_cache_stats():
+    context = runContext()
+    logger.info(
+        "Dimension cache: "
+        + str(context.cache_hits)
+        + " hits, "
+        + str(context.cache_misses)
+        + " misses"
+    )
+    context.cache_hits = 0
+    context.cache_misses = 0
+
+
+@contextmanager
+def stage(name):
+    # measures one pipeline stage and appends it to stage_reports
+    context = runContext()
+    with stats_lock:
+        start_http_requests = context.http_requests
+        start_http_bytes = context.http_bytes
+        start_db_statements = context.db_statements
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    profiler = None
+    if context.profile_dir is not None:
+        # only profiles the calling thread, worker threads show up as waits
+        profiler = cProfile.Profile()
+        profiler.enable()
     try:
-        getResources()
-        availabilities = getAvalibilities()
-        facilities = getOriginalFacilities(availabilities)
-        connect_db()
-        facilities = get_new_facilities(facilities)
-        if (len(facilities) != 0 ):
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            os.makedirs(context.profile_dir, exist_ok=True)
+            profiler.dump_stats(os.path.join(context.profile_dir, name + ".prof"))
+        with stats_lock:
+            report = {
+                "stage": name,
+                "wall_seconds": time.perf_counter() - start_wall,
+                "cpu_seconds": time.process_time() - start_cpu,
+                "peak_rss_bytes": peak_rss(),
+                "http_requests": context.http_requests - start_http_requests,
+                "http_bytes": context.http_bytes - start_http_bytes,
+                "db_statements": context.db_statements - start_db_statements,
+            }
+        context.stage_reports.append(report)
+        logger.info(
+            "Stage "
+            + name
+            + ": "
+            + format(report["wall_seconds"], ".2f")
+            + "s wall, "
+            + format(report["cpu_seconds"], ".2f")
+            + "s cpu, "
+            + str(report["http_requests"])
+            + " http requests, "
+            + str(report["http_bytes"])
+            + " bytes, "
+            + str(report["db_statements"])
+            + " db statements"
+        )
+
+
+def peak_rss():
+    # high-water mark of the whole process so far
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak
+    return peak * 1024
+
+
+def write_stage_report(run):
+    context = runContext()
+    if context.stage_report_path:
+        try:
+            with open(context.stage_report_path, "w") as fp:
+                json.dump(
+                    {
+                        "run": run,
+                        "city": context.city,
+                        "finished_at": datetime.now().isoformat(timespec="seconds"),
+                        "stages": context.stage_reports,
+                    },
+                    fp,
+                    indent=2,
+                )
+        except Exception as e:
+            logger.warning(e)
+
+    if context.stage_metrics_path:
+        lines = []
+        for metric, description in [
+            ("wall_seconds", "Wall clock time of the stage"),
+            ("cpu_seconds", "CPU time of the process during the stage"),
+            ("peak_rss_bytes", "Peak resident set size at the end of the stage"),
+            ("http_requests", "HTTP requests made during the stage"),
+            ("http_bytes", "HTTP response bytes read during the stage"),
+            ("db_statements", "Database statements executed during the stage"),
+        ]:
+            name = "active_toronto_stage_" + metric
+            lines.append("# HELP " + name + " " + description)
+            lines.append("# TYPE " + name + " gauge")
+            for report in context.stage_reports:
+                if report[metric] is not None:
+                    lines.append(
+                        name
+                        + '{city="'
+                        + context.city
+                        + '",run="'
+                        + run
+                        + '",stage="'
+                        + report["stage"]
+                        + '"} '
+                        + str(report[metric])
+                    )
+        try:
+            # the textfile collector must never see a half written file
+            with open(context.stage_metrics_path + ".tmp", "w") as fp:
+                fp.write("\n".join(lines) + "\n")
+            os.replace(context.stage_metrics_path + ".tmp", context.stage_metrics_path)
+        except Exception as e:
+            logger.warning(e)
+
+
+def exportParquet(availabilities, facilities):
+    # writes the availabilities of the run partitioned by category and ISO week,
+    # and its facilities, then swaps the result in place of the previous export
+    context = runContext()
+    if pa is None:
+        logger.warning("pyarrow is not installed, skipping the parquet export")
+        return False
+    logger.info("Exporting availabilities and facilities to " + context.export_dir)
+    staging = context.export_dir + ".staging"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(os.path.join(staging, "availabilities"))
+
+    rows = 0
+    batch = []
+    for availability in availabilities:
+        batch.append(availability)
+        if len(batch) >= EXPORT_BATCH_SIZE:
+            writeAvailabilityBatch(staging, batch, rows)
+            rows += len(batch)
+            batch = []
+    if len(batch) != 0:
+        writeAvailabilityBatch(staging, batch, rows)
+        rows += len(batch)
+
+    facilityColumns = [field.name for field in fields(Facility)]
+    df = pd.DataFrame(
+        [[getattr(facility, name) for name in facilityColumns] for facility in facilities],
+        columns=facilityColumns,
+    )
+    for name in ["lat", "lng"]:
+        df[name] = pd.to_numeric(df[name], errors="coerce")
+    for name in ["location_id", "facility_id"]:
+        df[name] = pd.to_numeric(df[name], errors="coerce").astype("Int64")
+    pq.write_table(
+        pa.Table.from_pandas(df, preserve_index=False),
+        os.path.join(staging, "facilities.parquet"),
+    )
+
+    # readers see either the previous export or this one
+    previous = context.export_dir + ".previous"
+    shutil.rmtree(previous, ignore_errors=True)
+    if os.path.exists(context.export_dir):
+        os.rename(context.export_dir, previous)
+    os.rename(staging, context.export_dir)
+    shutil.rmtree(previous, ignore_errors=True)
+    logger.info(
+        "Exported "
+        + str(rows)
+        + " availabilities and "
+        + str(len(facilities))
+        + " facilities"
+    )
+    return True
+
+
+def writeAvailabilityBatch(staging, batch, offset):
+    availabilityColumns = [field.name for field in fields(Availability)]
+    df = pd.DataFrame(
+        [[getattr(availability, name) for name in availabilityColumns] for availability in batch],
+        columns=availabilityColumns,
+    )
+    df["start_time"] = pd.to_datetime(df["start_time"], format="%Y-%m-%dT%H:%M:%S")
+    df["end_time"] = pd.to_datetime(df["end_time"], format="%Y-%m-%dT%H:%M:%S")
+    # streamed rows may carry decimals or strings for numbers
+    for name in ["location_id", "course_id", "age_min", "age_max"]:
+        df[name] = pd.to_numeric(df[name], errors="coerce").astype("Int64")
+    week = df["start_time"].dt.isocalendar()
+    df["week"] = week["year"].astype(str) + "-W" + week["week"].astype(str).str.zfill(2)
+    pq.write_to_dataset(
+        pa.Table.from_pandas(df, preserve_index=False),
+        root_path=os.path.join(staging, "availabilities"),
+        partition_cols=["category", "week"],
+        basename_template="part-" + str(offset) + "-{i}.parquet",
+    )
+
+
+def seed():
+    context = runContext()
+    logger.info("Start seeding Active-Toronto database...")
+    context.stage_reports.clear()
+    beginSnapshot()
+    try:
+        with stage("download"):
+            getResources()
+        with stage("parse"):
+            availabilities = withRegisteredPrograms(getAvalibilities())
+            facilities = getOriginalFacilities(availabilities)
+        with stage("geocode"):
             facilities = getGeoToFacilities(facilities)
+        with stage("scrape"):
             facilities = getPhoneUrlToFacilities(facilities)
-            update_db(availabilities, facilities)
-        
+        if context.export_dir is not None:
+            with stage("export"):
+                exportParquet(availabilities, facilities)
+        if context.load_db:
+            with stage("database"):
+                insert_data_to_empty_db(availabilities, facilities)
+        logger.info(
+            "------------------------------------------------End------------------------------------------------"
+        )
+    except Exception as e:
+        logger.warning(e)
+    saveSnapshot()
+    write_stage_report("seed")
+
+
+def update():
+    context = runContext()
+    logger.info("Start weekly updating...")
+    context.stage_reports.clear()
+    beginSnapshot()
+    try:
+        with stage("download"):
+            resources_ok = getResources()
+        if not resources_ok:
+            logger.warning("Could not get resources, skipping database update")
+        elif not any(name in context.changed_resources for name in ingestedResources()):
+            logger.info(
+                "No changes in "
+                + ", ".join(ingestedResources())
+                + ", skipping database update"
+            )
+            saveResourceState()
+        else:
+            # a rerun after a failure picks up the outputs of the stages that
+            # completed, facilities already in the database are not new anymore
+            context.availability_cutoff = datetime.now()
+            beginCheckpoint()
+            with stage("parse"):
+                if context.stream_dropins:
+                    # two passes over the file on disk instead of a list in memory,
+                    # the second one is parsed during the database stage
+                    if checkpointed("parse"):
+                        facilities = loadCheckpoint("facilities")
+                    else:
+                        facilities = getOriginalFacilities(
+                            withRegisteredPrograms(iterAvalibilities())
+                        )
+                    availabilities = withRegisteredPrograms(iterAvalibilities())
+                elif checkpointed("parse"):
+                    availabilities = loadCheckpoint("availabilities")
+                    facilities = loadCheckpoint("facilities")
+                else:
+                    availabilities = withRegisteredPrograms(getAvalibilities())
+                    facilities = getOriginalFacilities(availabilities)
+                if not checkpointed("parse"):
+                    saveCheckpoint(
+                        "parse",
+                        availabilities=None if context.stream_dropins else availabilities,
+                        facilities=facilities,
+                    )
+            # new facilities are enriched in place, so this list sees it too
+            allFacilities = facilities
+            if context.load_db:
+                with stage("lookup"):
+                    connect_db()
+                    load_dimension_cache()
+                    facilities = get_new_facilities(facilities)
+            if (len(facilities) != 0 ):
+                if checkpointed("geocode"):
+                    logger.info("Skipping geocode, restored from checkpoint")
+                else:
+                    with stage("geocode"):
+                        facilities = getGeoToFacilities(facilities)
+                    # a stage that failed or left a facility without its data is
+                    # not recorded, so the next run tries it again
+                    if facilities is not None and all(
+                        facility.lat is not None and facility.lng is not None
+                        for facility in facilities
+                    ):
+                        saveCheckpoint("geocode", facilities=allFacilities)
+                if checkpointed("scrape"):
+                    logger.info("Skipping scrape, restored from checkpoint")
+                else:
+                    with stage("scrape"):
+                        facilities = getPhoneUrlToFacilities(facilities)
+                    # facilities without a page keep no phone, that is not a failure
+                    if facilities is not None:
+                        saveCheckpoint("scrape", facilities=allFacilities)
+            if context.export_dir is not None:
+                with stage("export"):
+                    if context.stream_dropins:
+                        # one more pass over the file on disk
+                        exported = exportParquet(
+                            withoutEnded(withRegisteredPrograms(iterAvalibilities())),
+                            allFacilities,
+                        )
+                    else:
+                        exported = exportParquet(withoutEnded(availabilities), allFacilities)
+            # the state is saved once the data is in the database, or only
+            # exported when the database is not loaded
+            if context.load_db:
+                with stage("database"):
+                    updated = update_db(availabilities, facilities)
+            else:
+                updated = context.export_dir is not None and exported
+            if updated:
+                saveResourceState()
+                clearCheckpoint()
+
         logger.info(
             "------------------------------------------------End------------------------------------------------"
         )
     except Exception as e:
         logger.warning(e)
+    # a failed update leaves its checkpoint on disk for the next run
+    context.checkpoint = None
+    context.availability_cutoff = None
+    removeStreamedFiles()
+    saveSnapshot()
+    write_stage_report("update")
+
+
+def loadCities():
+    cities = dict(CITIES)
+    if os.path.exists(CITY_CONFIG_PATH):
+        with open(CITY_CONFIG_PATH) as fp:
+            cities.update(json.load(fp))
+    return cities
+
+
+def cityPath(path, city):
+    # the default city keeps the paths of a single city run
+    if not path or city == DEFAULT_CITY:
+        return path
+    root, ext = os.path.splitext(path)
+    return root + "_" + city + ext
+
+
+def getRunContext(city, workers=1):
+    settings = loadCities().get(city)
+    if settings is None:
+        raise ValueError("Unknown city: " + city)
+    return RunContext(
+        city=city,
+        city_id=settings["city_id"],
+        province=settings.get("province", PROVINCE),
+        country=settings.get("country", country),
+        resource_api=settings["resource_api"],
+        facility_url_prefix=settings.get("facility_url_prefix", FACILITY_URL_PREFIX),
+        facility_list_path=settings.get(
+            "facility_list_path", cityPath(FACILITY_LIST_PATH, city)
+        ),
+        facility_directory_path=settings.get(
+            "facility_directory_path", cityPath(FACILITY_DIRECTORY_PATH, city)
+        ),
+        # categories, the dimension caches and availability_view are per
+        # database, so every city has its own
+        database=settings.get(
+            "database", DATABASE if city == DEFAULT_CITY else DATABASE + "_" + city
+        ),
+        resource_state_path=cityPath(RESOURCE_STATE_PATH, city),
+        checkpoint_dir=cityPath(CHECKPOINT_DIR, city),
+        stage_report_path=cityPath(STAGE_REPORT_PATH, city),
+        stage_metrics_path=cityPath(STAGE_METRICS_PATH, city),
+        export_dir=cityPath(export_dir, city),
+        # the cities running at a time share one geocoding quota
+        geocode_rate_limit=GEOCODE_RATE_LIMIT / workers,
+        log_level=log_level,
+        seed_mode=seed_mode,
+        bulk_load=bulk_load,
+        force_update=force_update,
+        stream_dropins=stream_dropins,
+        availability_engine=availability_engine,
+        ingest_registered_programs=ingest_registered_programs,
+        sync_mode=sync_mode,
+        load_db=load_db,
+        replay_snapshot=replay_snapshot,
+        profile_dir=cityPath(profile_dir, city),
+    )
+
+
+def runContext():
+    # threads of a city run are bound to its context, any other thread works on
+    # the default city with the options from the command line
+    global default_context
+    context = getattr(run_local, "context", None)
+    if context is not None:
+        return context
+    if default_context is None:
+        default_context = getRunContext(DEFAULT_CITY)
+    return default_context
+
+
+def bindRunContext(context):
+    run_local.context = context
+
+
+def cityThreadPool(max_workers):
+    # worker threads count, record and log for the city that started them
+    return ThreadPoolExecutor(
+        max_workers=max_workers,
+        initializer=bindRunContext,
+        initargs=(runContext(),),
+    )
+
+
+def runCity(context, run):
+    # a forked worker inherits the driver's handlers, a spawned one has none;
+    # either way every log line of the worker names its city
+    if len(logging.getLogger().handlers) == 0:
+        setupHandlers(context.log_level)
+    bindRunContext(context)
+    if run == "seed":
+        seed()
+    else:
+        update()
+    return list(context.stage_reports)
+
+
+def runCities(cities, run):
+    workers = len(cities) if city_workers == 0 else min(city_workers, len(cities))
+    contexts = [getRunContext(city, workers) for city in cities]
+    logger.info(
+        "Running " + run + " of " + ", ".join(cities) + " in " + str(workers) + " processes"
+    )
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(runCity, context, run): context.city for context in contexts
+        }
+        for future in as_completed(futures):
+            try:
+                reports = future.result()
+                logger.info(
+                    "Finished "
+                    + run
+                    + " of "
+                    + futures[future]
+                    + " in {:.1f}s".format(sum(report["wall_seconds"] for report in reports))
+                )
+            except Exception as e:
+                logger.warning("Could not run " + futures[future] + ": " + str(e))
+
+
+def seedCities():
+    if run_cities is None:
+        seed()
+    else:
+        runCities(run_cities, "seed")
+    pruneSnapshots()
+
+
+def updateCities():
+    if run_cities is None:
+        update()
+    else:
+        runCities(run_cities, "update")
+    pruneSnapshots()
 
 
 if __name__ == "__main__":
-    time.sleep(60)
-    update()
-    schedule.every().saturday.at("02:00").do(update)
-    while 1:
-        schedule.run_pending()
-        time.sleep(1)
+    setuplogger()
+    if invalidate_geocodes:
+        invalidate_geocode_cache()
+    if check_plans:
+        connect_db()
+        sys.exit(0 if check_query_plans() else 1)
+    if run_cities is not None:
+        # unknown cities fail here, before any process is started
+        for city in run_cities:
+            getRunContext(city)
+    if seed_mode:
+        seedCities()
+    elif replay_snapshot is not None:
+        update()
+    else:
+        time.sleep(60)
+        updateCities()
+        schedule.every().saturday.at("02:00").do(updateCities)
+        while 1:
+            schedule.run_pending()
+            time.sleep(1)
@@ -153,6 +153,10 @@ CREATE TABLE `availability` (
   `MAX_AGE` int,
   `LAST_UPDATED` DATETIME DEFAULT CURRENT_TIMESTAMP,
   PRIMARY KEY (`ID`),
+  KEY `AVAILABILITY_FACILITY_ACTIVITY_START` (`FACILITY_ID`,`ACTIVITY_ID`,`START_TIME`),
+  KEY `AVAILABILITY_FACILITY_START` (`FACILITY_ID`,`START_TIME`),
+  KEY `AVAILABILITY_START_TIME` (`START_TIME`),
+  KEY `AVAILABILITY_END_TIME` (`END_TIME`),
   CONSTRAINT `AVAILABILITY_ibfk_1` FOREIGN KEY (`FACILITY_ID`) REFERENCES `facility` (`ID`),
   CONSTRAINT `AVAILABILITY_ibfk_2` FOREIGN KEY (`ACTIVITY_ID`) REFERENCES `activity` (`ID`)
 ) ENGINE=InnoDB AUTO_INCREMENT=20001, DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
@@ -178,10 +182,45 @@ CREATE TABLE `language_translation` (
   `DESCRIPTION` varchar(255) NOT NULL,
   `LAST_UPDATED` DATETIME DEFAULT CURRENT_TIMESTAMP,
   PRIMARY KEY (`TRANSLATION_ID`,`LANGUAGE_ID`),
+  -- the scraper reuses one translation per (language, description), see intern_translation()
+  UNIQUE KEY `LANGUAGE_TRANSLATION_DESCRIPTION` (`DESCRIPTION`,`LANGUAGE_ID`),
   CONSTRAINT `LANGUAGE_TRANSLATION_ibfk_1` FOREIGN KEY (`TRANSLATION_ID`) REFERENCES `translation` (`ID`),
   CONSTRAINT `LANGUAGE_TRANSLATION_ibfk_2` FOREIGN KEY (`LANGUAGE_ID`) REFERENCES `language` (`ID`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
 
+--
+-- Table structure for table `availability_view`
+--
+-- denormalized read model, rebuilt and swapped in by the scraper after every load
+CREATE TABLE `availability_view` (
+  `ID` int NOT NULL AUTO_INCREMENT,
+  `LANGUAGE_ID` char(2) NOT NULL,
+  `FACILITY_ID` int NOT NULL,
+  `LOCATION_ID` int NOT NULL,
+  `FACILITY_NAME` varchar(255),
+  `STREET` varchar(255),
+  `CITY` varchar(45),
+  `POSTAL_CODE` char(6),
+  `PHONE` varchar(12),
+  `URL` varchar(200),
+  `LATITUDE` double,
+  `LONGITUDE` double,
+  `CATEGORY_ID` int NOT NULL,
+  `CATEGORY` varchar(255) NOT NULL,
+  `TYPE` varchar(255) NOT NULL,
+  `ACTIVITY_ID` int NOT NULL,
+  `ACTIVITY` varchar(255) NOT NULL,
+  `START_TIME` DATETIME NOT NULL,
+  `END_TIME` DATETIME,
+  `MIN_AGE` int,
+  `MAX_AGE` int,
+  PRIMARY KEY (`ID`),
+  KEY `AVAILABILITY_VIEW_FACILITY_START` (`FACILITY_ID`,`START_TIME`),
+  KEY `AVAILABILITY_VIEW_CATEGORY_START` (`CATEGORY_ID`,`START_TIME`),
+  KEY `AVAILABILITY_VIEW_ACTIVITY_START` (`ACTIVITY_ID`,`START_TIME`),
+  KEY `AVAILABILITY_VIEW_START_TIME` (`START_TIME`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
 INSERT INTO `language` (`ID`, `title`) VALUES ("En", "English");
 INSERT INTO `language` (`ID`, `title`) VALUES ("Fr", "French");
 
@@ -0,0 +1,68 @@
+# Compares the loop and pandas engines of getAvalibilities on a synthetic
+# Drop-in.json. Usage: python benchmarks/bench_availabilities.py [rows]
+import logging
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+os.environ.setdefault("GOOGLE_API_KEY", "benchmark")
+os.environ.setdefault("MYSQL_USER", "benchmark")
+os.environ.setdefault("MYSQL_PASSWORD", "benchmark")
+os.environ.setdefault("MYSQL_DATABASE", "benchmark")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Scraper
+
+CATEGORIES = ["Arts", "Fitness", "Skate", "Sports", "Swim"]
+TITLES = [
+    "Lane Swim",
+    "Leisure Swim: Family",
+    "Aquafit (Deep Water)",
+    "Shinny - Adult",
+    "Pickleball: Older Adult (60+)",
+    "Drop-in Basketball",
+]
+
+
+def synthetic_dropins(rows):
+    start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    dropins = []
+    for i in range(rows):
+        startDatetime = start + timedelta(days=random.randint(-30, 60), hours=random.randint(6, 20))
+        dropins.append(
+            {
+                "Start Date Time": startDatetime.strftime("%Y-%m-%dT%H:%M:%S"),
+                "End Hour": min(startDatetime.hour + random.randint(1, 3), 23),
+                "End Min": random.choice([0, 15, 30, 45]),
+                "Category": random.choice(CATEGORIES),
+                "Location ID": random.randint(1, 1200),
+                "Course_ID": random.randint(1, 50000),
+                "Course Title": random.choice(TITLES),
+                "Age Min": random.choice(["None", 6, 13, 18, 60]),
+                "Age Max": random.choice(["None", 12, 17, 99]),
+            }
+        )
+    return dropins
+
+
+def timed(engine):
+    Scraper.runContext().availability_engine = engine
+    started = time.perf_counter()
+    availabilities = Scraper.getAvalibilities()
+    return time.perf_counter() - started, availabilities
+
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    Scraper.logger = logging.getLogger()
+    random.seed(0)
+    Scraper.runContext().dropins = synthetic_dropins(rows)
+
+    loop_seconds, expected = timed("loop")
+    pandas_seconds, actual = timed("pandas")
+    print("rows:   " + str(rows) + " (" + str(len(expected)) + " in the future)")
+    print("loop:   {:.2f}s".format(loop_seconds))
+    print("pandas: {:.2f}s ({:.1f}x)".format(pandas_seconds, loop_seconds / pandas_seconds))
+    print("identical output: " + str(expected == actual))
@@ -0,0 +1,104 @@
+# Serves synthetic facility pages from a local fixture server and compares the
+# old sequential scrape with scrapeFacilityPhones.
+# Usage: python benchmarks/bench_facility_pages.py [pages] [latency_ms]
+import http.server
+import logging
+import os
+import sys
+import threading
+import time
+
+import requests
+from bs4 import BeautifulSoup
+
+os.environ.setdefault("GOOGLE_API_KEY", "benchmark")
+os.environ.setdefault("MYSQL_USER", "benchmark")
+os.environ.setdefault("MYSQL_PASSWORD", "benchmark")
+os.environ.setdefault("MYSQL_DATABASE", "benchmark")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Scraper
+
+PAGE = """<html><head><title>Facility {0}</title></head><body>
+<div id="header">{1}</div>
+<div id="pfr_complex_loc"><h2>Location</h2><ul>
+<li>Phone: 416-395-{0:04d}</li><li>{0} Example St</li></ul></div>
+<div id="content">{2}</div>
+</body></html>"""
+FILLER = "<ul>" + "<li><a href='#'>Program listing</a></li>" * 400 + "</ul>"
+
+
+def serve_facility_pages(latency=0.0):
+    # returns (server, url prefix), pages are /<location id>/index.html
+    class FacilityPageHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            time.sleep(latency)
+            location_id = int(self.path.strip("/").split("/")[0])
+            body = PAGE.format(location_id, FILLER, FILLER).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FacilityPageHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:" + str(server.server_address[1]) + "/"
+
+
+def sequential_scrape(facilities):
+    # the scrape as it was before scrapeFacilityPhones
+    for facility in facilities:
+        url = Scraper.runContext().facility_url_prefix + str(facility.location_id) + "/index.html"
+        facility.url = url
+        soup = BeautifulSoup(requests.get(url=url).text, "lxml")
+        li = soup.find("div", attrs={"id": "pfr_complex_loc"}).find("ul").find("li")
+        if "Phone" in li.text.strip():
+            facility.phone = li.text.strip().split(":")[1].strip()
+    return facilities
+
+
+def synthetic_facilities(pages):
+    return [
+        Scraper.Facility(
+            location_id=i,
+            facility_name="Facility " + str(i),
+            city="Toronto and East York",
+            street=str(i) + " Example St",
+            province=Scraper.PROVINCE,
+            postal_code="",
+        )
+        for i in range(pages)
+    ]
+
+
+if __name__ == "__main__":
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    latency = (float(sys.argv[2]) if len(sys.argv) > 2 else 50) / 1000
+    Scraper.logger = logging.getLogger()
+    server, Scraper.runContext().facility_url_prefix = serve_facility_pages(latency)
+
+    started = time.perf_counter()
+    expected = sequential_scrape(synthetic_facilities(pages))
+    sequential_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    actual = Scraper.scrapeFacilityPhones(synthetic_facilities(pages))
+    concurrent_seconds = time.perf_counter() - started
+    server.shutdown()
+
+    print("pages:      " + str(pages) + " ({:.0f}ms latency)".format(latency * 1000))
+    print("sequential: {:.2f}s".format(sequential_seconds))
+    print(
+        "concurrent: {:.2f}s ({:.1f}x, {} workers)".format(
+            concurrent_seconds,
+            sequential_seconds / concurrent_seconds,
+            Scraper.SCRAPE_WORKERS,
+        )
+    )
+    print("identical output: " + str(expected == actual))
@@ -0,0 +1,427 @@
+# Runs the seed and update flows of Scraper.py offline and reports throughput
+# per stage. Synthetic CKAN resources, geocoder responses and facility pages
+# are served from a local stub, and the database writes go to a throwaway
+# database on a local MySQL or MariaDB server, which is dropped afterwards.
+#
+# Usage: python benchmarks/bench_pipeline.py [--rows 10000] [--locations 1000]
+#            [--flows seed,update] [--latency 0] [--skip-db] [--keep-db]
+#            [--save report.json] [--compare report.json] [--tolerance 0.2]
+#
+# The server is taken from BENCH_MYSQL_HOST, BENCH_MYSQL_PORT, BENCH_MYSQL_USER
+# and BENCH_MYSQL_PASSWORD (default root@127.0.0.1:3306 without a password).
+# The schema comes from Active_Toronto_Dumping.sql, which uses the MySQL 8
+# utf8mb4_0900_ai_ci collation (MariaDB 11.4 or later).
+# With --compare, stages that got slower by more than the tolerance are
+# reported as regressions and the exit code is 1.
+import argparse
+import http.server
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from urllib.parse import parse_qs, urlparse
+
+import mysql.connector as MySQL
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DUMP_PATH = os.path.join(ROOT, "Active_Toronto_Dumping.sql")
+# tables the scraper expects to be populated before seeding
+REFERENCE_TABLES = ["language", "city"]
+
+CATEGORIES = ["Arts", "Fitness", "Skate", "Sports", "Swim"]
+TITLES = [
+    "Lane Swim",
+    "Leisure Swim: Family",
+    "Aquafit (Deep Water)",
+    "Shinny - Adult",
+    "Pickleball: Older Adult (60+)",
+    "Drop-in Basketball",
+    "Public Skate",
+    "Yoga: Gentle",
+]
+DISTRICTS = ["Etobicoke York", "North York", "Scarborough", "Toronto and East York"]
+STREET_TYPES = ["St", "Ave", "Rd", "Blvd", "Dr"]
+
+PAGE = """<html><head><title>{1}</title></head><body>
+<div id="pfr_complex_loc"><h2>Location</h2><ul>
+<li>Phone: 416-395-{0:04d}</li><li>{0} Example St</li></ul></div>
+</body></html>"""
+
+
+def facility_name(location_id):
+    # every second facility is in the directory, the rest have to be scraped
+    if location_id % 2 == 0:
+        return "Listed Community Centre " + str(location_id)
+    return "Park Rink " + str(location_id)
+
+
+def synthetic_dropins(rows, locations, first_course_id=1, seed=0):
+    generator = random.Random(seed)
+    start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    dropins = []
+    for i in range(rows):
+        startDatetime = start + timedelta(
+            days=generator.randint(1, 60), hours=generator.randint(6, 20)
+        )
+        title = generator.choice(TITLES)
+        course = generator.randint(0, rows // 20 + 1)
+        dropins.append(
+            {
+                "Start Date Time": startDatetime.strftime("%Y-%m-%dT%H:%M:%S"),
+                "End Hour": min(startDatetime.hour + generator.randint(1, 3), 23),
+                "End Min": generator.choice([0, 15, 30, 45]),
+                "Category": CATEGORIES[TITLES.index(title) % len(CATEGORIES)],
+                "Location ID": generator.randint(1, locations),
+                "Course_ID": first_course_id + course,
+                "Course Title": title,
+                "Age Min": generator.choice(["None", "6", "13", "18", "60"]),
+                "Age Max": generator.choice(["None", "12", "17", "99"]),
+            }
+        )
+    return dropins
+
+
+def synthetic_locations(locations):
+    lines = [
+        "Location ID,Location Name,District,Street No,Street No Suffix,Street Name,Street Type,Postal Code"
+    ]
+    for location_id in range(1, locations + 1):
+        lines.append(
+            ",".join(
+                [
+                    str(location_id),
+                    facility_name(location_id),
+                    DISTRICTS[location_id % len(DISTRICTS)],
+                    str(location_id),
+                    "",
+                    "Example",
+                    STREET_TYPES[location_id % len(STREET_TYPES)],
+                    # some postal codes come from the geocoder
+                    "" if location_id % 7 == 0 else "M5V 1A1",
+                ]
+            )
+        )
+    return "\n".join(lines) + "\n"
+
+
+def synthetic_facilities(locations):
+    return [
+        {"Location ID": location_id, "Facility Type (Display Name)": "Pool"}
+        for location_id in range(1, locations + 1)
+    ]
+
+
+def write_facility_list(path, locations):
+    with open(path, "w") as fp:
+        for location_id in range(2, locations + 1, 2):
+            fp.write(
+                repr(
+                    {
+                        "Name": facility_name(location_id),
+                        "phone": "416-392-" + format(location_id % 10000, "04d"),
+                        "url": "https://www.toronto.ca/" + str(location_id),
+                    }
+                )
+                + "\n"
+            )
+
+
+def synthetic_payloads(rows, locations, seed):
+    # Drop-in.json and the other resources as served by CKAN
+    return {
+        "Drop-in.json": json.dumps(synthetic_dropins(rows, locations, seed=seed)).encode(),
+        "Facilities.json": json.dumps(synthetic_facilities(locations)).encode(),
+        "Registered Programs.json": b"[]",
+        "Locations": synthetic_locations(locations).encode(),
+    }
+
+
+def serve_stub(latency=0.0):
+    # returns (server, base url, payloads), payloads can be replaced between runs
+    payloads = {}
+
+    class StubHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            time.sleep(latency)
+            url = urlparse(self.path)
+            parts = url.path.strip("/").split("/")
+            if parts[0] == "package_show":
+                body = json.dumps(package_show(base, payloads)).encode()
+            elif parts[0] == "resources":
+                body = payloads[int(parts[1])][1]
+            elif parts[0] == "geocode":
+                body = json.dumps(geocode(parse_qs(url.query)["address"][0])).encode()
+            elif parts[0] == "facilities":
+                location_id = int(parts[1])
+                body = PAGE.format(location_id, facility_name(location_id)).encode()
+            else:
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = "http://127.0.0.1:" + str(server.server_address[1]) + "/"
+    return server, base, payloads
+
+
+def package_show(base, payloads):
+    return {
+        "result": {
+            "resources": [
+                {
+                    "name": name,
+                    "url": base + "resources/" + str(i),
+                    "last_modified": modified,
+                }
+                for i, (name, body, modified) in payloads.items()
+            ]
+        }
+    }
+
+
+def geocode(address):
+    generator = random.Random(address)
+    # only OK responses are written to the geocode cache
+    return {
+        "status": "OK",
+        "results": [
+            {
+                "geometry": {
+                    "location": {
+                        "lat": 43.6 + generator.random() / 10,
+                        "lng": -79.4 + generator.random() / 10,
+                    }
+                },
+                "address_components": [{"short_name": "M4C 1B5"}],
+            }
+        ]
+    }
+
+
+def publish(payloads, resources, modified):
+    payloads.clear()
+    for i, (name, body) in enumerate(resources.items()):
+        payloads[i] = (name, body, modified)
+
+
+def mysql_server():
+    return {
+        "host": os.environ.get("BENCH_MYSQL_HOST", "127.0.0.1"),
+        "port": int(os.environ.get("BENCH_MYSQL_PORT", "3306")),
+        "user": os.environ.get("BENCH_MYSQL_USER", "root"),
+        "password": os.environ.get("BENCH_MYSQL_PASSWORD", ""),
+    }
+
+
+def schema_statements():
+    # table definitions from the dump, without its data or database name
+    with open(DUMP_PATH, encoding="utf-8") as fp:
+        statements = fp.read().split(";\n")
+    for statement in statements:
+        lines = [line for line in statement.splitlines() if not line.startswith("--")]
+        statement = "\n".join(lines).strip()
+        if statement == "" or statement.startswith(
+            ("CREATE DATABASE", "USE ", "LOCK TABLES", "UNLOCK TABLES")
+        ):
+            continue
+        if statement.startswith("INSERT INTO"):
+            table = statement.split("`")[1]
+            if table not in REFERENCE_TABLES:
+                continue
+        yield statement
+
+
+def create_database(name):
+    cnx = MySQL.connect(**mysql_server())
+    cursor = cnx.cursor()
+    cursor.execute("CREATE DATABASE `" + name + "` CHARACTER SET utf8mb4")
+    cursor.execute("USE `" + name + "`")
+    for statement in schema_statements():
+        cursor.execute(statement)
+    cnx.commit()
+    cursor.close()
+    cnx.close()
+
+
+def drop_database(name):
+    cnx = MySQL.connect(**mysql_server())
+    cursor = cnx.cursor()
+    cursor.execute("DROP DATABASE IF EXISTS `" + name + "`")
+    cursor.close()
+    cnx.close()
+
+
+def configure(args, workdir, database):
+    # Scraper reads its settings at import time
+    server = mysql_server()
+    os.environ.setdefault("GOOGLE_API_KEY", "benchmark")
+    os.environ["MYSQL_HOST"] = server["host"]
+    os.environ["MYSQL_PORT"] = str(server["port"])
+    os.environ["MYSQL_USER"] = server["user"]
+    os.environ["MYSQL_PASSWORD"] = server["password"]
+    os.environ["MYSQL_DATABASE"] = database
+    os.environ["RESOURCE_API"] = args.base + "package_show"
+    os.environ["GOOGLE_API_URL"] = args.base + "geocode?address="
+    os.environ["FACILITY_URL_PREFIX"] = args.base + "facilities/"
+    os.environ["FACILITY_LIST_PATH"] = os.path.join(workdir, "FacilitiyList.txt")
+    os.environ["FACILITY_DIRECTORY_PATH"] = os.path.join(workdir, "FacilityDirectory.json")
+    os.environ["GEOCODE_CACHE_PATH"] = os.path.join(workdir, "geocode_cache.sqlite3")
+    os.environ["GEOCODE_RATE_LIMIT"] = "100000"
+    os.environ["RESOURCE_STATE_PATH"] = os.path.join(workdir, "resource_state.json")
+    # a resumed flow would skip stages and skew the timings
+    os.environ["CHECKPOINT_DIR"] = ""
+    os.environ["STAGE_REPORT_PATH"] = ""
+    os.environ["STAGE_METRICS_PATH"] = ""
+    sys.path.insert(0, ROOT)
+
+
+def run_flow(Scraper, flow, skip_db):
+    if skip_db:
+        # the stages of seed() up to the database writes
+        Scraper.runContext().stage_reports.clear()
+        with Scraper.stage("download"):
+            Scraper.getResources()
+        with Scraper.stage("parse"):
+            availabilities = Scraper.getAvalibilities()
+            facilities = Scraper.getOriginalFacilities(availabilities)
+        with Scraper.stage("geocode"):
+            facilities = Scraper.getGeoToFacilities(facilities)
+        with Scraper.stage("scrape"):
+            Scraper.getPhoneUrlToFacilities(facilities)
+    elif flow == "seed":
+        Scraper.runContext().seed_mode = True
+        Scraper.seed()
+        Scraper.runContext().seed_mode = False
+    else:
+        Scraper.update()
+    return [dict(report) for report in Scraper.runContext().stage_reports]
+
+
+def stage_items(stage, rows, locations):
+    # what a stage processes, to turn its wall time into a throughput
+    if stage in ("geocode", "scrape"):
+        return locations, "facilities"
+    return rows, "rows"
+
+
+def print_report(flow, reports, rows, locations):
+    print(flow + ":")
+    print(
+        "  {:<10} {:>9} {:>14} {:>9} {:>12} {:>9}".format(
+            "stage", "seconds", "throughput", "http", "bytes", "db"
+        )
+    )
+    for report in reports:
+        items, unit = stage_items(report["stage"], rows, locations)
+        report["items_per_second"] = items / max(report["wall_seconds"], 1e-9)
+        print(
+            "  {:<10} {:>9.2f} {:>14} {:>9} {:>12} {:>9}".format(
+                report["stage"],
+                report["wall_seconds"],
+                "{:.0f} {}/s".format(report["items_per_second"], unit[0]),
+                report["http_requests"],
+                report["http_bytes"],
+                report["db_statements"],
+            )
+        )
+
+
+def compare(results, baseline, tolerance):
+    # returns the stages whose throughput dropped by more than tolerance
+    regressions = []
+    for flow, reports in results.items():
+        previous = {
+            report["stage"]: report for report in baseline.get("flows", {}).get(flow, [])
+        }
+        for report in reports:
+            before = previous.get(report["stage"])
+            if before is None:
+                continue
+            change = report["items_per_second"] / before["items_per_second"] - 1
+            line = "  {}/{}: {:+.0%}".format(flow, report["stage"], change)
+            if change < -tolerance:
+                regressions.append(flow + "/" + report["stage"])
+                line += " REGRESSION"
+            print(line)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--locations", type=int, default=1000)
+    parser.add_argument("--flows", default="seed,update")
+    parser.add_argument("--latency", type=float, default=0, help="stub latency in ms")
+    parser.add_argument("--skip-db", action="store_true", help="stop before the database stage")
+    parser.add_argument("--keep-db", action="store_true")
+    parser.add_argument("--save", default=None, help="write the results to this file")
+    parser.add_argument("--compare", default=None, help="compare with saved results")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    server, args.base, payloads = serve_stub(args.latency / 1000)
+    workdir = tempfile.mkdtemp(prefix="bench_pipeline_")
+    database = "bench_active_" + str(os.getpid())
+    write_facility_list(os.path.join(workdir, "FacilitiyList.txt"), args.locations)
+    configure(args, workdir, database)
+
+    import Scraper
+
+    Scraper.logger = logging.getLogger()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    started = time.perf_counter()
+    seed_resources = synthetic_payloads(args.rows, args.locations, seed=0)
+    # the week after: most rows again, some new ones and some new locations
+    update_resources = synthetic_payloads(args.rows, args.locations * 11 // 10, seed=1)
+    update_resources["Drop-in.json"] = json.dumps(
+        json.loads(seed_resources["Drop-in.json"])[args.rows // 10 :]
+        + json.loads(update_resources["Drop-in.json"])[: args.rows // 10]
+    ).encode()
+    print(
+        "generated {} rows, {} locations in {:.1f}s".format(
+            args.rows, args.locations, time.perf_counter() - started
+        )
+    )
+
+    if not args.skip_db:
+        create_database(database)
+    results = {}
+    try:
+        for flow in args.flows.split(","):
+            if flow == "seed":
+                publish(payloads, seed_resources, "2024-01-01T00:00:00")
+            else:
+                publish(payloads, update_resources, "2024-01-08T00:00:00")
+            results[flow] = run_flow(Scraper, flow, args.skip_db)
+            print_report(flow, results[flow], args.rows, args.locations)
+    finally:
+        if not args.skip_db and not args.keep_db:
+            drop_database(database)
+        server.shutdown()
+
+    if args.save is not None:
+        with open(args.save, "w") as fp:
+            json.dump({"rows": args.rows, "locations": args.locations, "flows": results}, fp, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as fp:
+            regressions = compare(results, json.load(fp), args.tolerance)
+        if len(regressions) != 0:
+            sys.exit(1)
@@ -0,0 +1,83 @@
+# Measures the memory per row of availabilities and facilities as slotted
+# records against the dicts they replaced.
+# Usage: python benchmarks/bench_records.py [rows]
+import logging
+import os
+import sys
+import tracemalloc
+from dataclasses import asdict
+from datetime import datetime
+
+os.environ.setdefault("GOOGLE_API_KEY", "benchmark")
+os.environ.setdefault("MYSQL_USER", "benchmark")
+os.environ.setdefault("MYSQL_PASSWORD", "benchmark")
+os.environ.setdefault("MYSQL_DATABASE", "benchmark")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Scraper
+from bench_availabilities import synthetic_dropins
+
+
+def measure(build):
+    # returns (bytes allocated by build(), result)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before, result
+
+
+def availabilities_as_dicts(dropins, now):
+    return [asdict(Scraper.getAvailability(dropin, now)) for dropin in dropins]
+
+
+def availabilities_as_records(dropins, now):
+    return [Scraper.getAvailability(dropin, now) for dropin in dropins]
+
+
+def facility_row(i):
+    return Scraper.Facility(
+        location_id=i,
+        facility_name="Facility " + str(i),
+        city="Toronto and East York",
+        street=str(i) + " Example St",
+        province=Scraper.PROVINCE,
+        postal_code="M5V1A1",
+        phone="416-395-" + format(i % 10000, "04d"),
+        url="https://www.toronto.ca/" + str(i),
+        lat=43.6,
+        lng=-79.4,
+    )
+
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    Scraper.logger = logging.getLogger()
+    # every drop-in in the future, so each one becomes a row
+    dropins = synthetic_dropins(rows)
+    now = datetime(2000, 1, 1)
+
+    dict_bytes, expected = measure(lambda: availabilities_as_dicts(dropins, now))
+    del expected
+    record_bytes, actual = measure(lambda: availabilities_as_records(dropins, now))
+    del actual
+    print("availabilities: " + str(rows))
+    print("  dict:   {:.0f} bytes/row".format(dict_bytes / rows))
+    print(
+        "  record: {:.0f} bytes/row ({:.0%} less)".format(
+            record_bytes / rows, 1 - record_bytes / dict_bytes
+        )
+    )
+
+    dict_bytes, expected = measure(lambda: [asdict(facility_row(i)) for i in range(rows)])
+    del expected
+    record_bytes, actual = measure(lambda: [facility_row(i) for i in range(rows)])
+    del actual
+    print("facilities: " + str(rows))
+    print("  dict:   {:.0f} bytes/row".format(dict_bytes / rows))
+    print(
+        "  record: {:.0f} bytes/row ({:.0%} less)".format(
+            record_bytes / rows, 1 - record_bytes / dict_bytes
+        )
+    )
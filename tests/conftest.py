@@ -0,0 +1,28 @@
+import logging
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault("GOOGLE_API_KEY", "test")
+os.environ.setdefault("MYSQL_USER", "test")
+os.environ.setdefault("MYSQL_PASSWORD", "test")
+os.environ.setdefault("MYSQL_DATABASE", "test")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Scraper
+
+Scraper.logger = logging.getLogger()
+
+
+@pytest.fixture
+def context(tmp_path, monkeypatch):
+    # a fresh run of the default city, bound to the test's thread
+    monkeypatch.setattr(Scraper, "GEOCODE_CACHE_PATH", str(tmp_path / "geocode_cache.sqlite3"))
+    context = Scraper.getRunContext(Scraper.DEFAULT_CITY)
+    context.checkpoint_dir = str(tmp_path / "checkpoint")
+    Scraper.bindRunContext(context)
+    yield context
+    if context.geocode_cache is not None:
+        context.geocode_cache.close()
+    Scraper.bindRunContext(None)
@@ -0,0 +1,131 @@
+import json
+import os
+from datetime import datetime, timedelta
+
+import Scraper
+
+
+def resources(context, sha256="a"):
+    context.pending_resource_state = {
+        Scraper.DROPIN: {"sha256": sha256},
+        Scraper.LOCATIONS: {"sha256": "locations"},
+    }
+
+
+def availability(course_id):
+    start = datetime.now() + timedelta(days=1)
+    return Scraper.Availability(
+        start_time=start.strftime("%Y-%m-%dT%H:%M:%S"),
+        end_time=(start + timedelta(hours=1)).strftime("%Y-%m-%dT%H:%M:%S"),
+        category="Swim",
+        location_id=1,
+        course_id=course_id,
+        course_title="Lane Swim",
+        type="Lane Swim",
+    )
+
+
+def restart(context):
+    # the next run of the same city, in a new process
+    restarted = Scraper.getRunContext(Scraper.DEFAULT_CITY)
+    restarted.checkpoint_dir = context.checkpoint_dir
+    Scraper.bindRunContext(restarted)
+    return restarted
+
+
+def stored_checkpoint(context):
+    with open(os.path.join(context.checkpoint_dir, "checkpoint.json")) as fp:
+        return json.load(fp)
+
+
+def test_new_checkpoint(context):
+    resources(context)
+    Scraper.beginCheckpoint()
+    assert context.checkpoint["stages"] == []
+    assert context.checkpoint["availabilities"] == 0
+    assert context.availability_position == 0
+    assert not Scraper.checkpointed("parse")
+
+
+def test_stage_outputs_are_restored(context):
+    resources(context)
+    Scraper.beginCheckpoint()
+    Scraper.saveCheckpoint("parse", facilities=[1, 2, 3], locations=None)
+    assert stored_checkpoint(context)["stages"] == ["parse"]
+
+    restarted = restart(context)
+    resources(restarted)
+    Scraper.beginCheckpoint()
+    assert Scraper.checkpointed("parse")
+    assert not Scraper.checkpointed("geocode")
+    assert Scraper.loadCheckpoint("facilities") == [1, 2, 3]
+    assert not os.path.exists(os.path.join(context.checkpoint_dir, "locations.pickle"))
+
+
+def test_commit_records_the_watermark(context, monkeypatch):
+    monkeypatch.setattr(Scraper, "flush_and_commit", lambda: None)
+    resources(context)
+    Scraper.beginCheckpoint()
+    Scraper.begin_units()
+    context.availability_position = 5
+    Scraper.commit_units()
+    assert stored_checkpoint(context)["availabilities"] == 5
+
+
+def test_resume_from_the_watermark(context, monkeypatch):
+    monkeypatch.setattr(Scraper, "flush_and_commit", lambda: None)
+    resources(context)
+    Scraper.beginCheckpoint()
+    cutoff = context.checkpoint["cutoff"]
+    Scraper.begin_units()
+    context.availability_position = 3
+    Scraper.commit_units()
+
+    restarted = restart(context)
+    resources(restarted)
+    Scraper.beginCheckpoint()
+    assert restarted.availability_position == 3
+    # the same cutoff extracts the same availabilities in the same order
+    assert restarted.availability_cutoff.isoformat() == cutoff
+
+    stored = []
+    monkeypatch.setattr(
+        Scraper, "run_unit", lambda function, availability: stored.append(availability)
+    )
+    Scraper.store_new_availabilities(iter(availability(i) for i in range(6)))
+    assert [a.course_id for a in stored] == [3, 4, 5]
+    assert restarted.availability_position == 6
+
+
+def test_ended_availabilities_count_for_the_position(context, monkeypatch):
+    ended = availability(1)
+    ended.end_time = "2000-01-01T00:00:00"
+    stored = []
+    monkeypatch.setattr(
+        Scraper, "run_unit", lambda function, availability: stored.append(availability)
+    )
+    Scraper.store_new_availabilities(iter([availability(0), ended, availability(2)]))
+    assert [a.course_id for a in stored] == [0, 2]
+    assert context.availability_position == 3
+
+
+def test_changed_resources_start_over(context):
+    resources(context, "a")
+    Scraper.beginCheckpoint()
+    Scraper.saveCheckpoint("parse", facilities=[1])
+
+    restarted = restart(context)
+    resources(restarted, "b")
+    Scraper.beginCheckpoint()
+    assert not Scraper.checkpointed("parse")
+    assert restarted.availability_position == 0
+    assert not os.path.exists(os.path.join(context.checkpoint_dir, "facilities.pickle"))
+
+
+def test_replay_keeps_no_checkpoint(context):
+    context.replay_snapshot = "snapshot"
+    resources(context)
+    Scraper.beginCheckpoint()
+    assert context.checkpoint is None
+    Scraper.saveCheckpoint("parse", facilities=[1])
+    assert not os.path.exists(context.checkpoint_dir)
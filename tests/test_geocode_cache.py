@@ -0,0 +1,123 @@
+import Scraper
+
+
+def facility(location_id, street="100 Queen St W"):
+    return Scraper.Facility(
+        location_id=location_id,
+        facility_name="Facility " + str(location_id),
+        city="Toronto",
+        street=street,
+        province="Ontario",
+        postal_code="",
+    )
+
+
+class Geocoder:
+    # stands in for requestGeocode, counting the addresses it was asked for
+    def __init__(self, status="OK"):
+        self.status = status
+        self.calls = []
+
+    def __call__(self, addressStr):
+        self.calls.append(addressStr)
+        if self.status != "OK":
+            return {"status": self.status, "results": []}
+        return {
+            "status": "OK",
+            "results": [
+                {
+                    "geometry": {"location": {"lat": 43.65, "lng": -79.38}},
+                    "address_components": [{"short_name": "M5H 2N2"}],
+                }
+            ],
+        }
+
+
+def test_miss_then_hit(context):
+    geocoder = Geocoder()
+    first = Scraper.getGeo(facility(1), geocoder)
+    second = Scraper.getGeo(facility(2), geocoder)
+    assert geocoder.calls == ["100 Queen St W Toronto Ontario"]
+    assert (first.lat, first.lng, first.postal_code) == (43.65, -79.38, "M5H 2N2")
+    assert (second.lat, second.lng, second.postal_code) == (43.65, -79.38, "M5H 2N2")
+
+
+def test_addresses_are_case_and_space_insensitive(context):
+    geocoder = Geocoder()
+    Scraper.getGeo(facility(1, "100 Queen St W"), geocoder)
+    Scraper.getGeo(facility(2, "100  QUEEN st w "), geocoder)
+    assert len(geocoder.calls) == 1
+
+
+def test_facilities_at_one_address_share_a_request(context):
+    geocoder = Geocoder()
+    facilities = Scraper.getGeoToFacilities(
+        [facility(1), facility(2), facility(3, "1 Yonge St")], geocoder
+    )
+    assert sorted(geocoder.calls) == [
+        "1 Yonge St Toronto Ontario",
+        "100 Queen St W Toronto Ontario",
+    ]
+    assert all(f.lat == 43.65 for f in facilities)
+
+    Scraper.getGeoToFacilities([facility(4), facility(5, "1 Yonge St")], geocoder)
+    assert len(geocoder.calls) == 2
+
+
+def test_failed_lookups_are_not_cached(context):
+    Scraper.open_geocode_cache()
+    Scraper.geocode_cache_put("1 Nowhere Rd", Geocoder("ZERO_RESULTS")("1 Nowhere Rd"))
+    assert Scraper.geocode_cache_get("1 Nowhere Rd") is None
+
+
+def test_expired_entries_are_fetched_again(context, monkeypatch):
+    geocoder = Geocoder()
+    Scraper.getGeo(facility(1), geocoder)
+
+    now = Scraper.time.time()
+    later = now + (Scraper.GEOCODE_CACHE_TTL_DAYS + 1) * 86400
+    monkeypatch.setattr(Scraper.time, "time", lambda: later)
+    Scraper.getGeo(facility(2), geocoder)
+    assert len(geocoder.calls) == 2
+
+    # the new response is fresh again
+    Scraper.getGeo(facility(3), geocoder)
+    assert len(geocoder.calls) == 2
+
+
+def test_expired_entries_are_removed_on_open(context, monkeypatch):
+    Scraper.getGeo(facility(1), Geocoder())
+    context.geocode_cache.close()
+    context.geocode_cache = None
+
+    later = Scraper.time.time() + (Scraper.GEOCODE_CACHE_TTL_DAYS + 1) * 86400
+    monkeypatch.setattr(Scraper.time, "time", lambda: later)
+    Scraper.open_geocode_cache()
+    count = context.geocode_cache.execute("SELECT COUNT(*) FROM geocode").fetchone()[0]
+    assert count == 0
+
+
+def test_invalidate_one_address(context):
+    geocoder = Geocoder()
+    Scraper.getGeo(facility(1), geocoder)
+    Scraper.getGeo(facility(2, "1 Yonge St"), geocoder)
+
+    Scraper.invalidate_geocode_cache("100 QUEEN ST W Toronto Ontario")
+    Scraper.getGeo(facility(3), geocoder)
+    Scraper.getGeo(facility(4, "1 Yonge St"), geocoder)
+    assert geocoder.calls == [
+        "100 Queen St W Toronto Ontario",
+        "1 Yonge St Toronto Ontario",
+        "100 Queen St W Toronto Ontario",
+    ]
+
+
+def test_invalidate_everything(context):
+    geocoder = Geocoder()
+    Scraper.getGeo(facility(1), geocoder)
+    Scraper.getGeo(facility(2, "1 Yonge St"), geocoder)
+
+    Scraper.invalidate_geocode_cache()
+    Scraper.getGeo(facility(3), geocoder)
+    Scraper.getGeo(facility(4, "1 Yonge St"), geocoder)
+    assert len(geocoder.calls) == 4
@@ -0,0 +1,31 @@
+import pytest
+
+import Scraper
+
+
+@pytest.mark.parametrize(
+    "days, expected",
+    [
+        ("Monday", {0}),
+        ("Mon, Wed", {0, 2}),
+        ("Tu Th", {1, 3}),
+        ("Tues and Thurs", {1, 3}),
+        ("M W F", {0, 2, 4}),
+        ("TR", {1, 3}),
+        ("Saturdays, Sundays", {5, 6}),
+        ("Weekdays", {0, 1, 2, 3, 4}),
+        ("Weekends", {5, 6}),
+        ("weekend", {5, 6}),
+        ("SAT", {5}),
+    ],
+)
+def test_weekdays(days, expected):
+    assert Scraper.getWeekdays(days) == expected
+
+
+@pytest.mark.parametrize(
+    "days", ["", None, "Weekly", "Mon to Fri", "Mondayy", "Everyday"]
+)
+def test_unrecognised_days(days):
+    with pytest.raises(ValueError):
+        Scraper.getWeekdays(days)